@@ -0,0 +1,484 @@
+"""
+Async (ASGI) serving mode for the chat API.
+Serves /api/chat, the /api/voice endpoints, /api/health and /api/metrics
+with the same request and response format as app.py, but OpenRouter calls
+go through an async client, so a slow upstream call waits on the event loop
+instead of holding a worker thread. One process can keep hundreds of chats
+in flight.
+
+Conversation memory, key health, the duplicate cache and voice sessions are
+shared with app.py, which is imported for them.
+
+Run with:
+    uvicorn asgi_app:app --host 0.0.0.0 --port 5000
+or under gunicorn, with the worker count in WEB_CONCURRENCY (app.py reads it
+to decide which per-process caches are safe, and gunicorn uses it too):
+    WEB_CONCURRENCY=2 gunicorn asgi_app:app -k uvicorn.workers.UvicornWorker
+"""
+
+import asyncio
+import json
+import os
+import time
+
+from starlette.applications import Starlette
+from starlette.concurrency import run_in_threadpool
+from starlette.middleware import Middleware
+from starlette.middleware.cors import CORSMiddleware
+from starlette.responses import JSONResponse, Response, StreamingResponse
+from starlette.routing import Route
+
+try:
+    from openai import AsyncOpenAI
+    import httpx
+    async_openai_available = True
+except Exception as e:
+    AsyncOpenAI = None
+    httpx = None
+    async_openai_available = False
+    print("Warning: async openai client not available:", e)
+
+import app as chat_core
+from metrics import Registry
+from single_flight import AsyncSingleFlight
+from log_setup import get_logger
+from timing import StageTimer, new_request_id, span
+
+logger = get_logger('asgi_app')
+log_debug = logger.debug
+
+NO_CACHE_HEADERS = {
+    'Cache-Control': 'no-cache, no-store, must-revalidate',
+    'Pragma': 'no-cache',
+    'Expires': '0'
+}
+
+# Resends of a message whose reply is still being produced wait for that reply
+pending_replies = AsyncSingleFlight()
+
+# Model calls made for /api/chat/batch at once, across all batches
+_batch_slots = asyncio.Semaphore(chat_core.CHAT_BATCH_CONCURRENCY)
+
+# One async client per key sharing one connection pool, created on first use
+# inside the running event loop
+_async_clients = {}
+_async_http_client = None
+
+def get_async_client(api_key):
+    global _async_http_client
+    if not async_openai_available:
+        raise RuntimeError("OpenAI/OpenRouter client not available (openai package missing)")
+    client = _async_clients.get(api_key)
+    if client is None:
+        if _async_http_client is None:
+            _async_http_client = httpx.AsyncClient(
+                limits=httpx.Limits(max_connections=256, max_keepalive_connections=64, keepalive_expiry=120),
+                timeout=httpx.Timeout(30.0, connect=5.0)
+            )
+        client = AsyncOpenAI(api_key=api_key, base_url=chat_core.OPENROUTER_BASE_URL, http_client=_async_http_client)
+        _async_clients[api_key] = client
+    return client
+
+def _invalidate_async_clients(keys):
+    """Forget async clients for keys that were removed (see app.set_openrouter_keys)"""
+    for key in list(_async_clients):
+        if key not in keys:
+            del _async_clients[key]
+
+chat_core.key_change_listeners.append(_invalidate_async_clients)
+
+async def _request_completion_async(api_key, messages):
+    """Ask OpenRouter for a reply using one key; raises on API errors"""
+    client = get_async_client(api_key)
+    raw = await client.chat.completions.with_raw_response.create(
+        model="openai/gpt-3.5-turbo",
+        messages=messages,
+        max_tokens=50,
+        temperature=0.5
+    )
+    failed_until = chat_core._record_key_quota(api_key, raw.headers)
+    if failed_until:
+        await run_in_threadpool(chat_core._share_key_cooldown, api_key, failed_until)
+    return raw.parse().choices[0].message.content.strip()
+
+async def _hedged_completion_async(messages, first_key, tried):
+    """Async version of app._hedged_completion; losing requests are cancelled outright"""
+    in_flight = {}  # task -> api key
+    key_pool = chat_core.key_pool
+
+    def launch(api_key=None):
+        if api_key is None:
+            api_key = key_pool.next_key(exclude=tried)
+            if api_key is None:
+                return False
+            tried.add(api_key)
+        log_debug(f"[Hedge] Sending request on key {key_pool.label(api_key)} ({len(in_flight) + 1} in flight)")
+        in_flight[asyncio.ensure_future(_request_completion_async(api_key, messages))] = api_key
+        return True
+
+    launch(first_key)
+    keys_left = True
+    try:
+        while in_flight:
+            can_hedge = keys_left and len(in_flight) < chat_core.HEDGE_MAX_PARALLEL
+            done, _ = await asyncio.wait(list(in_flight), timeout=chat_core.HEDGE_DELAY_SECONDS if can_hedge else None,
+                                         return_when=asyncio.FIRST_COMPLETED)
+            if not done:
+                keys_left = launch()
+                continue
+            for task in done:
+                api_key = in_flight.pop(task)
+                try:
+                    reply = task.result()
+                except Exception as err:
+                    await run_in_threadpool(chat_core._report_key_failure, api_key, err)
+                    reply = None
+                if reply:
+                    log_debug(f"[Hedge] Key {key_pool.label(api_key)} answered first: {reply[:100]}...")
+                    chat_core._report_key_success(api_key)
+                    return reply
+                if keys_left:
+                    keys_left = launch()
+        return None
+    finally:
+        for task in in_flight:
+            task.cancel()
+
+async def get_chat_response_async(message, voice='friendly', conversation=[]):
+    """Async version of app.get_chat_response (callers try answer_locally() first)"""
+    key_pool = chat_core.key_pool
+    messages, clean_conversation, voice = chat_core._build_messages(message, voice, conversation)
+
+    with span('response_cache'):
+        reply = chat_core._cached_reply(message, voice, clean_conversation)
+    if reply:
+        return reply
+
+    # Shared state may be SQLite or Redis: keep its calls off the event loop
+    await run_in_threadpool(chat_core._sync_key_cooldowns)
+    log_debug(f"[get_chat_response_async] Starting with {len(key_pool)} keys ({key_pool.available_count()} available)")
+    log_debug(f"[get_chat_response_async] Message: {message}")
+
+    tried = set()
+    while True:
+        with span('key_select'):
+            current_key = key_pool.next_key(exclude=tried)
+        if current_key is None:
+            break
+        tried.add(current_key)
+        key_label = key_pool.label(current_key)
+
+        if chat_core.HEDGE_DELAY_SECONDS > 0:
+            started = time.perf_counter()
+            with span('upstream', key=key_label, hedged=True):
+                reply = await _hedged_completion_async(messages, current_key, tried)
+            if reply:
+                chat_core.upstream_latency.observe(time.perf_counter() - started, voice)
+                chat_core._remember_reply(message, voice, clean_conversation, reply)
+                return reply
+            break
+
+        try:
+            log_debug(f"[Key Rotation] Trying key {key_label} (attempt {len(tried)} of {len(key_pool)})")
+            started = time.perf_counter()
+            with span('upstream', key=key_label) as attempt:
+                attempt['ok'] = False
+                reply = await _request_completion_async(current_key, messages)
+                attempt['ok'] = True
+            chat_core.upstream_latency.observe(time.perf_counter() - started, voice)
+            log_debug(f"[API Response] Got reply: {reply[:100]}...")
+            if reply:
+                log_debug(f"[Key Rotation] Success with key {key_label}")
+                chat_core._report_key_success(current_key)
+                chat_core._remember_reply(message, voice, clean_conversation, reply)
+                return reply
+        except Exception as err:
+            await run_in_threadpool(chat_core._report_key_failure, current_key, err)
+            await asyncio.sleep(0.1)
+            continue
+
+    log_debug(f"[Fallback] All API attempts exhausted (tried {len(tried)} of {len(key_pool)} keys), using intelligent fallback")
+    with span('fallback', keys_tried=len(tried)):
+        return chat_core._fallback_reply(message, voice, clean_conversation)
+
+async def _read_json(request):
+    try:
+        return await request.json() or {}
+    except Exception:
+        return None
+
+async def _answer_and_save(timer, user_id, user_message, normalized_message, voice, current_time):
+    logger.info(f"[NEW MESSAGE] User {user_id}: '{user_message[:50]}...' at {current_time}")
+
+    # The memory store may touch disk, so keep it off the event loop
+    with timer.stage('memory_load'):
+        user_conversation = await run_in_threadpool(chat_core.memory_store.get_conversation, user_id)
+
+    with timer.stage('model'):
+        reply = await get_chat_response_async(user_message, voice, user_conversation)
+
+    if not reply or not reply.strip():
+        logger.error("[ERROR] Empty reply from get_chat_response_async")
+        reply = "I'm having some connectivity issues right now, but I'm still here to chat!"
+
+    with timer.stage('memory_save'):
+        await run_in_threadpool(chat_core._save_exchange, user_id, user_message, normalized_message,
+                                reply, current_time, user_conversation)
+    return reply
+
+async def chat(request):
+    data = await _read_json(request)
+    if data is None:
+        return JSONResponse({"reply": "Error: Invalid JSON data", "success": False}, status_code=400)
+
+    timer = None
+    try:
+        user_message = (data.get('message', '') or '').strip()
+        user_id = data.get('user_id', 'default_user')
+        voice = data.get('voice', 'Anna')
+        is_mobile = data.get('is_mobile', False)
+        if voice not in chat_core.ALLOWED_VOICES:
+            voice = 'Anna'
+        system_voice_name = chat_core.BACKEND_VOICE_MAP.get(voice, 'Microsoft Anna')
+
+        if not user_message:
+            return JSONResponse({
+                "reply": "Please provide a message to chat with me!",
+                "success": False,
+                "user_id": user_id
+            }, status_code=400)
+
+        current_time = time.time()
+        normalized_message = user_message.lower().strip()
+
+        cached = await run_in_threadpool(chat_core._find_duplicate, user_id, normalized_message, current_time)
+        if cached:
+            return JSONResponse({
+                "reply": cached['response'],
+                "source": "cache",
+                "duplicate": True,
+                "success": True,
+                "user_id": user_id
+            })
+
+        timer = StageTimer(new_request_id(request.headers.get('x-request-id')))
+        timer.activate()
+        is_exit_phrase = chat_core.detect_exit_phrase(user_message)
+
+        with timer.stage('fast_path'):
+            local = chat_core.answer_locally(user_message)
+
+        if local:
+            reply, intent = local
+            await run_in_threadpool(chat_core._cache_message, user_id, normalized_message, reply, current_time)
+            response_data = {"source": "local", "intent": intent, "message_saved": False}
+        else:
+            reply, coalesced = await pending_replies.do((user_id, normalized_message), _answer_and_save,
+                                                  timer, user_id, user_message, normalized_message, voice, current_time)
+            if coalesced:
+                chat_core.coalesced_requests.inc()
+                logger.info(f"[DUPLICATE COALESCED] User {user_id}: '{normalized_message[:30]}' (in flight)")
+                response_data = {"source": "coalesced", "duplicate": True, "message_saved": False}
+            else:
+                response_data = {"message_saved": True}
+
+        response_data.update({
+            "reply": reply,
+            "voice_response_finished": True,
+            "selected_voice": voice,
+            "backend_voice": system_voice_name,
+            "timestamp": current_time,
+            "user_id": user_id,
+            "success": True,
+            "is_mobile": is_mobile,
+            "voice_session": await run_in_threadpool(chat_core._voice_session_after_reply,
+                                                     user_id, user_message, is_exit_phrase)
+        })
+        response_data["timings"] = timer.as_dict()
+        response_data["request_id"] = timer.request_id
+        chat_core.record_chat_metrics(voice, response_data.get("source", "api"), timer)
+        with timer.stage('serialize'):
+            response = JSONResponse(response_data, headers=NO_CACHE_HEADERS)
+        response.headers['Server-Timing'] = timer.server_timing()
+        response.headers['X-Request-ID'] = timer.request_id
+        if request.headers.get('x-timing'):
+            response.headers['X-Timing'] = json.dumps(timer.span_list(), separators=(',', ':'))
+        return response
+
+    except Exception as e:
+        logger.exception(f"Uncaught error in chat: {e}")
+        return JSONResponse({
+            "reply": "Oops, something went wrong on my end. Let's give it another shot!",
+            "error": str(e),
+            "success": False
+        })
+    finally:
+        if timer is not None:
+            timer.finish(path=request.url.path)
+
+async def _answer_batch_chain(items, indexes, current_time):
+    """app._answer_batch_chain, with the model called on the event loop"""
+    results, turns, to_save = {}, [], []
+    conversation = None
+    previous = None
+    for index in indexes:
+        item = items[index]
+        try:
+            result = await run_in_threadpool(chat_core._batch_quick_result, item, current_time, previous)
+            if result is None:
+                if conversation is None:
+                    conversation = await run_in_threadpool(chat_core.memory_store.get_conversation, item['user_id'])
+                async with _batch_slots:
+                    reply = await get_chat_response_async(item['message'], item['voice'], conversation)
+                result = chat_core._batch_api_result(item, reply)
+                new_turns = [
+                    {"role": "user", "content": item['message']},
+                    {"role": "assistant", "content": result['reply']}
+                ]
+                conversation = (conversation + new_turns)[-chat_core.memory_store.max_entries:]
+                turns.extend(new_turns)
+                to_save.append(index)
+        except Exception as e:
+            result = chat_core._batch_error_result(item, e)
+        results[index] = result
+        if result['status'] == 'ok':
+            previous = (item['message'].lower().strip(), result['reply'])
+    return results, turns, to_save
+
+async def chat_batch(request):
+    items, error = chat_core.parse_batch_items(await _read_json(request))
+    if error:
+        return JSONResponse({"error": error, "success": False}, status_code=400)
+
+    timer = StageTimer(new_request_id(request.headers.get('x-request-id')))
+    timer.activate()
+    try:
+        current_time = time.time()
+        results = [None] * len(items)
+        writes, to_save = {}, []
+        with timer.stage('answer', items=len(items)):
+            chains = chat_core.group_batch_items(items)
+            answered = await asyncio.gather(*[_answer_batch_chain(items, chain, current_time) for chain in chains])
+            for chain, (chain_results, turns, chain_to_save) in zip(chains, answered):
+                for index, result in chain_results.items():
+                    results[index] = result
+                if turns:
+                    writes[items[chain[0]]['user_id']] = turns
+                to_save.extend(chain_to_save)
+        with timer.stage('memory_save', users=len(writes)):
+            await run_in_threadpool(chat_core._save_batch, items, results, writes, to_save, current_time)
+        for result in results:
+            chat_core.batch_items.inc(result['status'])
+
+        response = JSONResponse({
+            "results": results,
+            "success": True,
+            "timestamp": current_time,
+            "timings": timer.as_dict(),
+            "request_id": timer.request_id
+        }, headers=NO_CACHE_HEADERS)
+        response.headers['Server-Timing'] = timer.server_timing()
+        response.headers['X-Request-ID'] = timer.request_id
+        return response
+    finally:
+        timer.finish(path=request.url.path)
+
+async def voice_status(request):
+    try:
+        data = await _read_json(request) or {}
+        return JSONResponse(await run_in_threadpool(chat_core.poll_voice_session, data.get('user_id', 'default_user')))
+    except Exception as e:
+        logger.exception(f"[Voice Status] Error: {e}")
+        return JSONResponse({"error": str(e)}, status_code=500)
+
+async def voice_events(request):
+    """Server-Sent Events replacing /api/voice/status polling.
+
+    Sends "listening_window" (the session status, on connect and after each
+    reply), "silence_prompt" when the user has been quiet for
+    VOICE_SESSION_TIMEOUT, and "session_ended" with a reason (silence,
+    exit_phrase, expired, ended). Only offered with a single worker (see
+    app.VOICE_EVENTS_ENABLED); /api/health tells the page whether to use it.
+    """
+    if not chat_core.VOICE_EVENTS_ENABLED:
+        return JSONResponse({"error": "Voice events need a single worker; poll /api/voice/status"},
+                            status_code=404)
+    user_id = request.query_params.get('user_id', 'default_user')
+    loop = asyncio.get_running_loop()
+    events = asyncio.Queue(maxsize=100)
+
+    def put(item):
+        if not events.full():
+            events.put_nowait(item)
+
+    def deliver(event, payload):
+        # Called from request and timer threads
+        loop.call_soon_threadsafe(put, (event, payload))
+
+    chat_core.voice_events.subscribe(user_id, deliver)
+    await run_in_threadpool(chat_core._schedule_silence_check, user_id)
+
+    async def generate():
+        try:
+            status = await run_in_threadpool(chat_core.get_voice_session_status, user_id)
+            yield chat_core._sse_event('listening_window', status)
+            while True:
+                try:
+                    event, payload = await asyncio.wait_for(events.get(), chat_core.VOICE_EVENTS_KEEPALIVE)
+                except asyncio.TimeoutError:
+                    yield ": keepalive\n\n"
+                    continue
+                yield chat_core._sse_event(event, payload)
+        finally:
+            chat_core.voice_events.unsubscribe(user_id, deliver)
+
+    return StreamingResponse(generate(), media_type='text/event-stream',
+                             headers={'Cache-Control': 'no-cache', 'X-Accel-Buffering': 'no'})
+
+async def voice_end(request):
+    try:
+        data = await _read_json(request) or {}
+        await run_in_threadpool(chat_core.end_voice_session, data.get('user_id', 'default_user'))
+        return JSONResponse({"success": True, "message": "Voice session ended"})
+    except Exception as e:
+        logger.exception(f"[Voice End] Error: {e}")
+        return JSONResponse({"error": str(e)}, status_code=500)
+
+async def health(request):
+    return JSONResponse({
+        "ok": True,
+        "keys": len(chat_core.openrouter_keys),
+        "openai_available": async_openai_available,
+        "voice_events": chat_core.VOICE_EVENTS_ENABLED,
+        "mode": "asgi"
+    })
+
+async def metrics(request):
+    # Some gauges (voice sessions) read shared state
+    body = await run_in_threadpool(chat_core.metrics.render)
+    return Response(body, headers={'Content-Type': Registry.CONTENT_TYPE})
+
+routes = [
+    Route('/chat', chat, methods=['POST']),
+    Route('/api/chat', chat, methods=['POST']),
+    Route('/api/chat/batch', chat_batch, methods=['POST']),
+    Route('/api/voice/status', voice_status, methods=['POST']),
+    Route('/api/voice/end', voice_end, methods=['POST']),
+    Route('/api/voice/events', voice_events, methods=['GET']),
+    Route('/health', health, methods=['GET']),
+    Route('/api/health', health, methods=['GET']),
+    Route('/api/metrics', metrics, methods=['GET']),
+]
+
+app = Starlette(
+    routes=routes,
+    middleware=[
+        # Same open CORS policy as the Flask app; also answers OPTIONS preflights
+        Middleware(CORSMiddleware, allow_origins=['*'], allow_methods=['GET', 'POST', 'OPTIONS'],
+                   allow_headers=['Content-Type', 'Authorization', 'X-Requested-With'])
+    ]
+)
+
+if __name__ == '__main__':
+    import uvicorn
+    uvicorn.run(app, host='0.0.0.0', port=int(os.getenv('PORT', 5000)))
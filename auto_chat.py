@@ -1,5 +1,10 @@
+import os
+import queue
 import time
 import requests
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+from requests.adapters import HTTPAdapter
 from selenium import webdriver
 from selenium.webdriver.chrome.service import Service
 from selenium.webdriver.common.by import By
@@ -9,6 +14,214 @@ from selenium.webdriver.support.ui import WebDriverWait
 from selenium.webdriver.support import expected_conditions as EC
 import threading
 
+CHAT_API_URL = os.getenv('CHAT_API_URL', 'http://localhost:5000/chat')
+# 'observer' pushes new chat messages from the page as they appear;
+# 'poll' is the old loop that re-reads the last message every 2 seconds
+BRIDGE_MODE = os.getenv('BRIDGE_MODE', 'observer')
+BRIDGE_WORKERS = int(os.getenv('BRIDGE_WORKERS', '4'))  # chat API requests at once
+BRIDGE_WAIT_SECONDS = 1  # how long one wait for new messages blocks the browser thread
+BRIDGE_RETRIES = 2  # attempts per message, only when the connection failed before the request was sent
+
+# Marks every .chat-message already on the page as seen, then numbers each
+# new one as it is added and queues {id, text}. A waiting
+# execute_async_script call (see WAIT_FOR_MESSAGES_JS) is woken right away.
+OBSERVER_JS = """
+if (window.__bzikQueue) { return false; }
+window.__bzikQueue = [];
+window.__bzikNextId = 1;
+window.__bzikWaiter = null;
+function collect(node) {
+    if (node.nodeType !== 1) { return []; }
+    var found = Array.prototype.slice.call(node.querySelectorAll('.chat-message'));
+    if (node.classList.contains('chat-message')) { found.unshift(node); }
+    return found;
+}
+collect(document.body).forEach(function(node) { node.setAttribute('data-bzik-id', '0'); });
+new MutationObserver(function(mutations) {
+    var added = false;
+    mutations.forEach(function(mutation) {
+        mutation.addedNodes.forEach(function(node) {
+            collect(node).forEach(function(message) {
+                if (message.hasAttribute('data-bzik-id')) { return; }
+                var id = window.__bzikNextId++;
+                message.setAttribute('data-bzik-id', String(id));
+                window.__bzikQueue.push({id: id, text: message.innerText});
+                added = true;
+            });
+        });
+    });
+    if (added && window.__bzikWaiter) { window.__bzikWaiter(); }
+}).observe(document.body, {childList: true, subtree: true});
+return true;
+"""
+
+# Returns queued messages as soon as there are any, [] after the wait time,
+# or null if the page was reloaded and the observer is gone
+WAIT_FOR_MESSAGES_JS = """
+var done = arguments[arguments.length - 1];
+var waitMs = arguments[0];
+if (!window.__bzikQueue) { done(null); return; }
+if (window.__bzikQueue.length) { done(window.__bzikQueue.splice(0)); return; }
+var waiter = function() {
+    window.__bzikWaiter = null;
+    done(window.__bzikQueue.splice(0));
+};
+window.__bzikWaiter = waiter;
+setTimeout(function() {
+    if (window.__bzikWaiter === waiter) {
+        window.__bzikWaiter = null;
+        done([]);
+    }
+}, waitMs);
+"""
+
+
+def make_session():
+    """One keep-alive connection per worker to the chat API"""
+    session = requests.Session()
+    adapter = HTTPAdapter(pool_connections=1, pool_maxsize=BRIDGE_WORKERS)
+    session.mount('http://', adapter)
+    session.mount('https://', adapter)
+    return session
+
+
+def ask_backend(session, request_id, user_id, user_message):
+    """Reply from the chat API, or None; runs on a worker thread.
+
+    Only a failed connection is retried. After a read timeout or an error
+    response the backend may still be answering, and a retry that arrives
+    after its 15 second duplicate window would be answered twice.
+    """
+    for attempt in range(1, BRIDGE_RETRIES + 1):
+        try:
+            response = session.post(CHAT_API_URL, json={'message': user_message, 'user_id': user_id},
+                                    headers={'X-Request-ID': request_id}, timeout=(3, 30))
+        except requests.exceptions.ConnectionError as e:
+            print(f"ChatAPI connection failed (attempt {attempt}): {e}")
+            continue
+        except Exception as e:
+            print(f"ChatAPI request failed: {e}")
+            return None
+        if response.status_code == 200:
+            return response.json()['reply']
+        print(f"ChatAPI error: {response.status_code} - {response.text}")
+        return None
+    return None
+
+
+def bridge_messages(driver, chat_input, send_button):
+    """Event-driven loop: the page pushes new messages, workers ask the API.
+
+    Only this thread touches the driver. Every message gets an ID in the
+    page when it is first added and is submitted once; IDs at or below the
+    last one handled are ignored. One user's messages are answered one at a
+    time, in order, so their replies and memory turns don't race; different
+    users are answered in parallel.
+    """
+    session = make_session()
+    executor = ThreadPoolExecutor(max_workers=BRIDGE_WORKERS, thread_name_prefix='bridge')
+    replies = queue.Queue()  # replies from the workers, typed by this thread
+    driver.set_script_timeout(BRIDGE_WAIT_SECONDS + 10)
+    driver.execute_script(OBSERVER_JS)
+    last_id = 0
+    page_load = 1  # part of each request ID, since message IDs restart on reload
+    print(f"Bridge started: {BRIDGE_WORKERS} workers -> {CHAT_API_URL}")
+
+    waiting = {}  # user_id -> messages not yet answered, while a worker is on that user
+    waiting_lock = threading.Lock()
+
+    def answer_user(user_id):
+        while True:
+            with waiting_lock:
+                if not waiting[user_id]:
+                    del waiting[user_id]
+                    return
+                request_id, user_message = waiting[user_id].popleft()
+            reply = ask_backend(session, request_id, user_id, user_message)
+            if reply:
+                replies.put(reply)
+
+    def submit(request_id, user_id, user_message):
+        with waiting_lock:
+            if user_id in waiting:
+                waiting[user_id].append((request_id, user_message))
+                return
+            waiting[user_id] = deque([(request_id, user_message)])
+        executor.submit(answer_user, user_id)
+
+    while True:
+        try:
+            new_messages = driver.execute_async_script(WAIT_FOR_MESSAGES_JS, BRIDGE_WAIT_SECONDS * 1000)
+            if new_messages is None:
+                # Page reloaded: earlier messages are marked seen again and IDs restart
+                driver.execute_script(OBSERVER_JS)
+                last_id = 0
+                page_load += 1
+                new_messages = []
+            for item in new_messages:
+                message_id = int(item['id'])
+                if message_id <= last_id:
+                    continue
+                last_id = message_id
+                text = item.get('text') or ''
+                # Extract user and message, assume format "User: Message"
+                if ": " not in text:
+                    continue
+                user_part, user_message = text.split(": ", 1)
+                # Skip own messages if detected
+                if user_part.lower().startswith("bzik"):
+                    continue
+                submit(f"bridge-{page_load}-{message_id}", user_part, user_message)
+
+            while True:
+                try:
+                    reply = replies.get_nowait()
+                except queue.Empty:
+                    break
+                # Type in chat
+                chat_input.send_keys(reply)
+                send_button.click()
+        except Exception as e:
+            print(f"Error in chat bridge: {e}")
+            time.sleep(1)
+
+
+def poll_messages(driver, chat_input, send_button):
+    """The old loop: look at the last message every 2 seconds"""
+    last_message = ""
+
+    while True:
+        # Check for new messages
+        try:
+            messages = driver.find_elements(By.CLASS_NAME, "chat-message")  # Adjust class
+            if messages:
+                latest_message = messages[-1].text  # Get latest
+                if latest_message != last_message:
+                    last_message = latest_message
+
+                    # Extract user and message, assume format "User: Message"
+                    if ": " in latest_message:
+                        user_part, user_message = latest_message.split(": ", 1)
+                        # Skip own messages if detected
+                        if not user_part.lower().startswith("bzik"):
+                            # Send to API
+                            try:
+                                response = requests.post(CHAT_API_URL, json={'message': user_message, 'user_id': user_part}, timeout=10)
+                                if response.status_code == 200:
+                                    reply = response.json()['reply']
+                                    # Type in chat
+                                    chat_input.send_keys(reply)
+                                    send_button.click()
+                                else:
+                                    print(f"ChatAPI error: {response.status_code} - {response.text}")
+                            except Exception as e:
+                                print(f"ChatAPI request failed: {e}")
+        except Exception as e:
+            print(f"Error in chat monitoring: {e}")
+
+        time.sleep(2)  # Poll every 2 seconds
+
+
 def run_automation():
     # Set up WebDriver
     service = Service(ChromeDriverManager().install())
@@ -61,38 +274,10 @@ def run_automation():
             print("Available elements: " + ', '.join([elem.get_attribute('id') for elem in driver.find_elements(By.CSS_SELECTOR, '*') if elem.get_attribute('id')]))
             return  # Exit if can't find chat
 
-        last_message = ""
-
-        while True:
-            # Check for new messages
-            try:
-                messages = driver.find_elements(By.CLASS_NAME, "chat-message")  # Adjust class
-                if messages:
-                    latest_message = messages[-1].text  # Get latest
-                    if latest_message != last_message:
-                        last_message = latest_message
-
-                        # Extract user and message, assume format "User: Message"
-                        if ": " in latest_message:
-                            user_part, user_message = latest_message.split(": ", 1)
-                            # Skip own messages if detected
-                            if not user_part.lower().startswith("bzik"):
-                                # Send to API
-                                try:
-                                    response = requests.post('http://localhost:5000/chat', json={'message': user_message, 'user_id': user_part}, timeout=10)
-                                    if response.status_code == 200:
-                                        reply = response.json()['reply']
-                                        # Type in chat
-                                        chat_input.send_keys(reply)
-                                        send_button.click()
-                                    else:
-                                        print(f"ChatAPI error: {response.status_code} - {response.text}")
-                                except Exception as e:
-                                    print(f"ChatAPI request failed: {e}")
-            except Exception as e:
-                print(f"Error in chat monitoring: {e}")
-
-            time.sleep(2)  # Poll every 2 seconds
+        if BRIDGE_MODE == 'poll':
+            poll_messages(driver, chat_input, send_button)
+        else:
+            bridge_messages(driver, chat_input, send_button)
 
     except Exception as e:
         print(f"Automation error: {e}")
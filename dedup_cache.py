@@ -0,0 +1,53 @@
+"""
+Last message per user, for duplicate suppression.
+Entries only matter for DUPLICATE_WINDOW_SECONDS. The cache stamps each
+entry when it is inserted (the entry's own 'time' is when its request
+started, which can be well before the reply is cached) and expires on that
+stamp, so insertion order is expiry order: expired entries are popped from
+the front in bulk and the oldest entry is evicted in O(1) when the cache is
+full, instead of scanning every user with min().
+"""
+
+import threading
+import time
+from collections import OrderedDict
+
+
+class DuplicateMessageCache:
+    """user_id -> {'text', 'time', 'response'}, oldest insertion first"""
+
+    def __init__(self, window, max_users=1000):
+        self.window = window
+        self.max_users = max_users
+        self._entries = OrderedDict()  # user_id -> (inserted_at, entry)
+        self._lock = threading.Lock()
+
+    def get(self, user_id):
+        item = self._entries.get(user_id)
+        if item is None or time.time() - item[1]['time'] >= self.window:
+            return None
+        return item[1]
+
+    def put(self, user_id, entry):
+        with self._lock:
+            now = time.monotonic()
+            self._entries.pop(user_id, None)
+            self._entries[user_id] = (now, entry)
+            self._expire(now)
+            while len(self._entries) > self.max_users:
+                self._entries.popitem(last=False)
+
+    def _expire(self, now):
+        """Drop entries inserted more than a window ago from the front (caller holds the lock).
+
+        An entry's request time is never later than its insertion, so an entry
+        dropped here is already past its own window as far as get() is concerned.
+        """
+        while self._entries:
+            inserted_at, _ = next(iter(self._entries.values()))
+            if now - inserted_at < self.window:
+                break
+            self._entries.popitem(last=False)
+
+    def __len__(self):
+        return len(self._entries)
@@ -0,0 +1,95 @@
+"""
+Fuzzy lookup of canned replies (CUSTOM_RESPONSES).
+An exact normalized match only catches one wording of each question, so
+"who's your boss" or "what is ur name" went to the paid API. The index here
+expands common contractions and chat shorthand, looks candidates up through
+an inverted token index and scores them with IDF-weighted token Jaccard plus
+character trigram cosine similarity.
+"""
+
+import math
+
+from response_cache import trigram_vector, cosine_similarity
+
+# Shorthand and contractions (as they look after punctuation is stripped)
+TOKEN_EXPANSIONS = {
+    'u': ['you'], 'ur': ['your'], 'r': ['are'], 'ya': ['you'],
+    'whos': ['who', 'is'], 'whats': ['what', 'is'], 'wats': ['what', 'is'], 'wat': ['what'],
+    'hows': ['how', 'is'], 'wheres': ['where', 'is'], 'youre': ['you', 'are'],
+    'im': ['i', 'am'], 'cant': ['can', 'not'], 'dont': ['do', 'not'], 'doin': ['doing'],
+    'pls': ['please'], 'plz': ['please'], 'thx': ['thanks'], 'abt': ['about'],
+    'whom': ['who'], 'made': ['created'], 'built': ['created'],
+}
+
+
+def expand_tokens(normalized_text):
+    tokens = []
+    for token in normalized_text.split():
+        tokens.extend(TOKEN_EXPANSIONS.get(token, [token]))
+    return tokens
+
+
+class FuzzyResponseIndex:
+    """Matches a message to the closest canned question above a confidence threshold.
+
+    `responses` maps normalized questions to replies. Scoring is
+    0.6 * token Jaccard + 0.4 * trigram cosine over the expanded text. Tokens
+    are weighted by inverse document frequency across the questions, so
+    "what is your boss name" doesn't match "what is your name" just because
+    it shares the filler words: the rare token "boss" counts for more.
+    """
+
+    def __init__(self, responses, normalize, threshold=0.8):
+        self.normalize = normalize
+        self.threshold = threshold
+        self._exact = {}
+        self._entries = []  # (question, reply, token set, trigram vector)
+        self._index = {}  # token -> list of entry positions
+        for question, reply in responses.items():
+            expanded = ' '.join(expand_tokens(question))
+            self._exact[question] = reply
+            self._exact.setdefault(expanded, reply)
+            tokens = frozenset(expanded.split())
+            position = len(self._entries)
+            self._entries.append((question, reply, tokens, trigram_vector(expanded)))
+            for token in tokens:
+                self._index.setdefault(token, []).append(position)
+
+        count = max(len(self._entries), 1)
+        self._idf = {token: math.log(1 + count / len(positions)) for token, positions in self._index.items()}
+        self._unknown_idf = math.log(1 + count)  # words no question uses weigh the most
+
+    def _weight(self, tokens):
+        return sum(self._idf.get(token, self._unknown_idf) for token in tokens)
+
+    def match(self, message):
+        """Return (reply, score, matched question) or None"""
+        normalized = self.normalize((message or '').replace('-', ' '))
+        if not normalized:
+            return None
+        reply = self._exact.get(normalized)
+        if reply is not None:
+            return reply, 1.0, normalized
+
+        expanded = ' '.join(expand_tokens(normalized))
+        reply = self._exact.get(expanded)
+        if reply is not None:
+            return reply, 1.0, expanded
+
+        tokens = frozenset(expanded.split())
+        candidates = set()
+        for token in tokens:
+            candidates.update(self._index.get(token, ()))
+        if not candidates:
+            return None
+
+        vector = trigram_vector(expanded)
+        best = None
+        best_score = self.threshold
+        for position in candidates:
+            question, reply, entry_tokens, entry_vector = self._entries[position]
+            jaccard = self._weight(tokens & entry_tokens) / self._weight(tokens | entry_tokens)
+            score = 0.6 * jaccard + 0.4 * cosine_similarity(vector, entry_vector)
+            if score >= best_score:
+                best, best_score = (reply, score, question), score
+        return best
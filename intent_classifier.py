@@ -0,0 +1,216 @@
+"""
+Local intent classifier for small talk.
+Greetings, "how are you", thanks, goodbyes and "what can you do" make up a
+large share of messages, and only their exact wordings were answered without
+a paid OpenRouter call. This classifier (hashed word and character n-grams
+fed to a softmax linear model, NumPy only) routes other wordings of them to
+the fallback replies when it is confident, and everything else ("other")
+to the model. It is trained from the examples below in well under a second
+when the app starts, or loaded from INTENT_MODEL_PATH if that file exists.
+"""
+
+import os
+import zlib
+
+try:
+    import numpy as np
+except ImportError:  # the classifier stage is skipped without NumPy
+    np = None
+
+from fallback_responses import GREETINGS, HOW_ARE_YOU_PHRASES, HELP_PHRASES, THANKS_PHRASES, GOODBYE_PHRASES
+from fuzzy_match import expand_tokens
+from log_setup import get_logger
+
+logger = get_logger('intent_classifier')
+
+HASH_DIMENSIONS = 2 ** 12
+OTHER = 'other'
+
+TRAINING_EXAMPLES = {
+    'greeting': sorted(GREETINGS) + [
+        "hello there", "hi there", "hey bzik", "hi bzik", "hello bzik", "good morning", "good afternoon",
+        "good evening", "morning", "hiya", "howdy", "greetings", "hey hey", "hello friend", "heyy", "hii",
+        "helloo", "yo bzik", "hey buddy", "hi again", "hello again", "hey you",
+    ],
+    'how_are_you': HOW_ARE_YOU_PHRASES + [
+        "how are you doing", "how are you today", "how r u", "how are u", "hows it going", "how is it going",
+        "how do you do", "how have you been", "how are things", "hows your day", "how is your day going",
+        "you doing ok", "are you ok", "how you feeling", "how are you feeling today", "whats new with you",
+        "hey how are you", "hi how are you doing",
+    ],
+    'thanks': THANKS_PHRASES + [
+        "thank you", "thank you so much", "thanks a lot", "thx", "ty", "many thanks", "thanks bzik",
+        "thanks for the help", "thank you very much", "much appreciated", "cheers", "great thanks",
+        "ok thanks", "awesome thank you", "thanks that helps", "i appreciate it",
+    ],
+    'goodbye': GOODBYE_PHRASES + [
+        "bye bye", "see you later", "see ya", "talk to you later", "later", "good night", "goodnight",
+        "catch you later", "gotta go", "i have to go", "im leaving now", "bye for now", "have a nice day",
+        "ok bye", "thanks bye", "see you soon", "farewell", "cya",
+    ],
+    'help': HELP_PHRASES + [
+        "what can you do", "what can you help me with", "can you help me", "i need help", "help me",
+        "what do you do", "how can you help", "what are you able to do", "what can i ask you",
+        "how do i use this", "what should i ask", "can you assist me",
+    ],
+    OTHER: [
+        "what is the capital of france", "tell me a joke", "write a poem about the sea", "explain quantum physics",
+        "what is the weather like today", "how do i cook pasta", "who won the world cup", "what time is it",
+        "translate hello into spanish", "how does a car engine work", "recommend a good book",
+        "what is machine learning", "how old is the universe", "can you write some python code",
+        "what should i eat for dinner", "why is the sky blue", "tell me about your business features",
+        "what is your pricing", "do you have an api", "who created you", "what is your name",
+        "how do i reset my password", "i have a problem with my order", "my app keeps crashing",
+        "how far is the moon", "tell me a story", "what are your features", "who is bagrat",
+        "how are you built", "how are taxes calculated", "how are babies made", "how is the stock market today",
+        "how do you say thank you in french", "say goodbye to my friend in a poem", "what does hello mean",
+        "help me write an email to my boss", "i need help with my homework", "can you help me fix this bug",
+        "thanks to whom was the telephone invented", "bye the way what is ai", "what is the meaning of life",
+        "give me a recipe for pancakes", "summarize the news", "how many people live in tokyo",
+        "what is two plus two", "play some music", "what is bitcoin", "are you a robot",
+        "do you like movies", "what is your favorite color", "how tall is mount everest", "tell me about dogs",
+        "how old are you", "how smart are you", "how are you so smart", "how are you different from siri",
+        "where are you from", "who are you", "are you real", "what are you", "how tall are you",
+        "how do you work", "good morning in japanese", "hello world in java", "i love you", "yes", "no",
+    ],
+}
+
+
+def _features(tokens):
+    """Hashed word unigrams/bigrams and character trigrams, as (index, weight) pairs"""
+    grams = [f"w:{token}" for token in tokens]
+    grams += [f"b:{a} {b}" for a, b in zip(tokens, tokens[1:])]
+    for token in tokens:
+        padded = f"^{token}$"
+        grams += [f"c:{padded[i:i + 3]}" for i in range(len(padded) - 2)]
+    counts = {}
+    for gram in grams:
+        # crc32 rather than hash(): it is the same in every process, so saved models stay valid
+        index = zlib.crc32(gram.encode('utf-8')) % HASH_DIMENSIONS
+        counts[index] = counts.get(index, 0) + 1
+    return counts
+
+
+class HashedIntentClassifier:
+    """Softmax regression over hashed n-gram features.
+
+    classify(message) returns (intent, confidence); any object with that
+    method can stand in for it in app.py.
+    """
+
+    def __init__(self, normalize, intents=None, weights=None, bias=None):
+        self.normalize = normalize
+        self.intents = intents
+        self.weights = weights  # HASH_DIMENSIONS x len(intents)
+        self.bias = bias
+
+    def _vector(self, text):
+        vector = np.zeros(HASH_DIMENSIONS)
+        for index, count in _features(expand_tokens(self.normalize(text))).items():
+            vector[index] = count
+        norm = np.linalg.norm(vector)
+        return vector / norm if norm else vector
+
+    def train(self, examples=TRAINING_EXAMPLES, epochs=400, learning_rate=8.0, l2=1e-4):
+        self.intents = sorted(examples)
+        texts = [(text, label) for label, intent in enumerate(self.intents) for text in examples[intent]]
+        x = np.array([self._vector(text) for text, _ in texts])
+        y = np.zeros((len(texts), len(self.intents)))
+        y[np.arange(len(texts)), [label for _, label in texts]] = 1
+        # Only columns some example hashes into can get non-zero weights
+        active = np.flatnonzero(x.any(axis=0))
+        x = x[:, active]
+        weights = np.zeros((len(active), len(self.intents)))
+        bias = np.zeros(len(self.intents))
+        for _ in range(epochs):
+            error = (self._softmax(x @ weights + bias) - y) / len(texts)
+            weights -= learning_rate * (x.T @ error + l2 * weights)
+            bias -= learning_rate * error.sum(axis=0)
+        self.weights = np.zeros((HASH_DIMENSIONS, len(self.intents)))
+        self.weights[active] = weights
+        self.bias = bias
+        return self
+
+    @staticmethod
+    def _softmax(scores):
+        scores = scores - scores.max(axis=-1, keepdims=True)
+        exp = np.exp(scores)
+        return exp / exp.sum(axis=-1, keepdims=True)
+
+    def classify(self, message):
+        vector = self._vector(message)
+        if not vector.any():
+            return OTHER, 1.0
+        probabilities = self._softmax(vector @ self.weights + self.bias)
+        best = int(probabilities.argmax())
+        return self.intents[best], float(probabilities[best])
+
+    def save(self, path):
+        np.savez(path, intents=np.array(self.intents), weights=self.weights, bias=self.bias)
+
+    def load(self, path):
+        with np.load(path) as model:
+            self.intents = [str(intent) for intent in model['intents']]
+            self.weights = model['weights']
+            self.bias = model['bias']
+        return self
+
+
+class IntentRouter:
+    """Decides whether a classified message is answered locally.
+
+    Short messages only (small talk is short), and only when the classifier's
+    confidence reaches the threshold for that intent.
+    """
+
+    def __init__(self, classifier, threshold=0.85, thresholds=None, max_words=8):
+        self.classifier = classifier
+        self.threshold = threshold
+        self.thresholds = thresholds or {}
+        self.max_words = max_words
+
+    def route(self, message):
+        """Return (intent, confidence) if the message can be answered locally, else None"""
+        if len(message.split()) > self.max_words:
+            return None
+        intent, confidence = self.classifier.classify(message)
+        if intent == OTHER or confidence < self.thresholds.get(intent, self.threshold):
+            return None
+        return intent, confidence
+
+
+def parse_thresholds(spec):
+    """"greeting=0.7,goodbye=0.9" -> {"greeting": 0.7, "goodbye": 0.9}"""
+    thresholds = {}
+    for part in spec.split(','):
+        name, _, value = part.partition('=')
+        if name.strip() and value.strip():
+            thresholds[name.strip()] = float(value)
+    return thresholds
+
+
+def create_intent_classifier(kind, normalize, model_path=None):
+    """Build the configured classifier ('hashed' or 'off'); None when disabled"""
+    if kind == 'off':
+        return None
+    if kind != 'hashed':
+        logger.warning(f"[Intent] Unknown intent classifier '{kind}', using hashed")
+    if np is None:
+        logger.warning("[Intent] NumPy not installed, local intent classification disabled")
+        return None
+    classifier = HashedIntentClassifier(normalize)
+    if model_path and os.path.exists(model_path):
+        try:
+            return classifier.load(model_path)
+        except Exception as e:
+            logger.warning(f"[Intent] Could not load {model_path} ({e}), training from built-in examples")
+    return classifier.train()
+
+
+if __name__ == "__main__":
+    # Train from the built-in examples and save, for INTENT_MODEL_PATH
+    import sys
+    from app import _normalize
+    path = sys.argv[1] if len(sys.argv) > 1 else 'intent_model.npz'
+    HashedIntentClassifier(_normalize).train().save(path)
+    print(f"Saved intent model to {path}")
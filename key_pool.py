@@ -0,0 +1,260 @@
+"""
+Thread-safe scheduling of OpenRouter API keys.
+Requests ask the pool for the next healthy key by value instead of indexing
+into a shared list, so concurrent requests can never shift keys under each
+other, and the pool spreads them over every key that is working.
+"""
+
+import heapq
+import threading
+import time
+
+
+def is_rate_limit_error(error_str):
+    """True if an API error means the key is rate-limited or out of credit"""
+    error_lower = error_str.lower()
+    return (
+        "rate limit" in error_lower or "quota" in error_lower or "429" in error_str
+        or "402" in error_str or "insufficient" in error_lower
+    )
+
+
+def key_error_kind(error_str):
+    """Classify an API error for metrics: 402 (out of credit), 429 (rate-limited) or error"""
+    error_lower = error_str.lower()
+    if "402" in error_str or "insufficient" in error_lower:
+        return "402"
+    if "429" in error_str or "rate limit" in error_lower or "quota" in error_lower:
+        return "429"
+    return "error"
+
+
+def parse_rate_limit_headers(headers, now=None):
+    """(limit, remaining, reset_at) from OpenRouter's X-RateLimit-* headers, or None.
+
+    X-RateLimit-Reset is a Unix time in milliseconds; a bare Retry-After
+    (seconds) on a 429 gives only the reset time.
+    """
+    if not headers:
+        return None
+    now = time.time() if now is None else now
+    try:
+        reset = headers.get('x-ratelimit-reset')
+        if reset is not None:
+            reset_at = float(reset)
+            if reset_at > 1e11:  # milliseconds
+                reset_at /= 1000.0
+            limit = headers.get('x-ratelimit-limit')
+            remaining = headers.get('x-ratelimit-remaining')
+            return (int(float(limit)) if limit is not None else None,
+                    int(float(remaining)) if remaining is not None else None,
+                    reset_at)
+        retry_after = headers.get('retry-after')
+        if retry_after is not None:
+            return None, 0, now + float(retry_after)
+    except (TypeError, ValueError):
+        pass
+    return None
+
+
+class KeyState:
+    """Health record for a single key"""
+    __slots__ = ('key', 'index', 'failed_until', 'last_failure', 'last_success',
+                 'successes', 'failures', 'rate_limited', 'rate_limit_streak', 'current_weight',
+                 'quota_limit', 'quota_remaining', 'quota_reset')
+
+    def __init__(self, key, index):
+        self.key = key
+        self.index = index  # position in the configured list, used for logging
+        self.failed_until = 0.0
+        self.last_failure = 0.0
+        self.last_success = 0.0
+        self.successes = 0
+        self.failures = 0
+        self.rate_limited = 0
+        self.rate_limit_streak = 0  # rate limits since the last success
+        self.current_weight = 0.0  # smooth weighted round-robin counter
+        self.quota_limit = None  # from the last response's rate-limit headers
+        self.quota_remaining = None
+        self.quota_reset = 0.0
+
+    def weight(self, now):
+        """Share of traffic: the fraction of quota left until its reset (when
+        OpenRouter has told us), times the smoothed success ratio"""
+        weight = (self.successes + 1) / (self.successes + self.failures + 2)
+        if self.quota_remaining is not None and self.quota_limit and now < self.quota_reset:
+            weight *= (self.quota_remaining + 1) / (self.quota_limit + 1)
+        return weight
+
+
+class KeyPool:
+    """Hands out API keys by smooth weighted round-robin.
+
+    Every healthy key gets a turn, weighted by the quota it has left (from
+    OpenRouter's X-RateLimit-* headers, see report_quota) and its success
+    ratio, so traffic spreads over all keys and a key close to its limit gets
+    less of it. A key with no quota left, or that failed, goes into a
+    cooldown heap ordered by expiry and rejoins the rotation when it ends:
+    at the quota reset time if the response said, otherwise after a cooldown
+    that doubles with each rate limit in a row (up to `max_cooldown`).
+
+    Picking a key is O(number of healthy keys) rather than O(1): weights
+    change with every response, and an O(1) structure (an alias table, or
+    a heap keyed on weight) would have to be rebuilt or re-sifted on each
+    change, which costs more than scanning the handful of keys we configure.
+    """
+
+    def __init__(self, keys, cooldown=60, rate_limit_cooldown=None, max_cooldown=3600):
+        self.cooldown = cooldown
+        self.rate_limit_cooldown = rate_limit_cooldown if rate_limit_cooldown is not None else cooldown
+        self.max_cooldown = max_cooldown
+        self._lock = threading.Lock()
+        self.set_keys(keys)
+
+    def set_keys(self, keys):
+        """Replace the configured keys, keeping history for keys that stay"""
+        with self._lock:
+            old = getattr(self, '_states', {})
+            self._states = {}
+            for index, key in enumerate(keys):
+                state = old.get(key) or KeyState(key, index)
+                state.index = index
+                state.failed_until = 0.0
+                state.current_weight = 0.0
+                self._states[key] = state
+            self._healthy = dict.fromkeys(self._states)  # insertion-ordered set
+            self._cooldown = []  # heap of (failed_until, key)
+
+    def __len__(self):
+        return len(self._states)
+
+    def label(self, key):
+        state = self._states.get(key)
+        return f"#{state.index}" if state else "#?"
+
+    def _release_expired(self, now):
+        """Move keys whose cooldown has ended back into the rotation (caller holds the lock)"""
+        while self._cooldown and self._cooldown[0][0] <= now:
+            failed_until, key = heapq.heappop(self._cooldown)
+            state = self._states.get(key)
+            # Skip stale heap entries (key removed, or failed again since)
+            if state is None or state.failed_until != failed_until:
+                continue
+            state.current_weight = 0.0
+            self._healthy[key] = None
+
+    def next_key(self, exclude=()):
+        """Return the next healthy key not in `exclude`, or None if none is available"""
+        with self._lock:
+            now = time.time()
+            self._release_expired(now)
+            best = None
+            total = 0.0
+            for key in self._healthy:
+                if key in exclude:
+                    continue
+                state = self._states[key]
+                weight = state.weight(now)
+                state.current_weight += weight
+                total += weight
+                if best is None or state.current_weight > best.current_weight:
+                    best = state
+            if best is None:
+                return None
+            best.current_weight -= total
+            return best.key
+
+    def report_success(self, key):
+        with self._lock:
+            state = self._states.get(key)
+            if state is None:
+                return
+            state.successes += 1
+            state.last_success = time.time()
+            state.rate_limit_streak = 0
+
+    def report_quota(self, key, limit, remaining, reset_at):
+        """Record the rate-limit headers of a response on this key.
+
+        A key with nothing left sits out until `reset_at`; returns that time
+        in that case (for sharing with other workers), else None.
+        """
+        with self._lock:
+            state = self._states.get(key)
+            if state is None:
+                return None
+            if limit is not None:
+                state.quota_limit = limit
+            state.quota_remaining = remaining
+            state.quota_reset = reset_at
+            now = time.time()
+            if remaining is None or remaining > 0 or reset_at <= now:
+                return None
+            self._cool_down(state, min(reset_at, now + self.max_cooldown))
+            return state.failed_until
+
+    def report_failure(self, key, rate_limited=False, retry_at=None):
+        """Put the key into cooldown; returns when it ends.
+
+        A rate-limited key rests until `retry_at` when the error said when its
+        quota resets, otherwise for a cooldown that doubles with each rate
+        limit in a row.
+        """
+        with self._lock:
+            state = self._states.get(key)
+            if state is None:
+                return
+            now = time.time()
+            state.failures += 1
+            state.last_failure = now
+            if rate_limited:
+                state.rate_limited += 1
+                state.rate_limit_streak += 1
+                if retry_at and retry_at > now:
+                    cooldown = retry_at - now
+                else:
+                    cooldown = self.rate_limit_cooldown * 2 ** min(state.rate_limit_streak - 1, 16)
+            else:
+                cooldown = self.cooldown
+            self._cool_down(state, now + min(cooldown, self.max_cooldown))
+            return state.failed_until
+
+    def _cool_down(self, state, until):
+        """Take a key out of the rotation until `until` (caller holds the lock)"""
+        state.failed_until = until
+        self._healthy.pop(state.key, None)  # already cooling down: the newer failed_until wins
+        heapq.heappush(self._cooldown, (until, state.key))
+
+    def apply_cooldown(self, key, failed_until):
+        """Cool a key down until `failed_until` because another worker saw it fail.
+
+        Doesn't count as a failure here; a cooldown that ends sooner than the
+        one already in place is ignored.
+        """
+        with self._lock:
+            state = self._states.get(key)
+            if state is None or failed_until <= max(state.failed_until, time.time()):
+                return
+            self._cool_down(state, failed_until)
+
+    def available_count(self):
+        with self._lock:
+            self._release_expired(time.time())
+            return len(self._healthy)
+
+    def snapshot(self):
+        """Per-key health for diagnostics (never includes the key itself)"""
+        now = time.time()
+        with self._lock:
+            return [
+                {
+                    "key": f"#{s.index}",
+                    "successes": s.successes,
+                    "failures": s.failures,
+                    "rate_limited": s.rate_limited,
+                    "weight": round(s.weight(now), 3),
+                    "quota_remaining": s.quota_remaining,
+                    "cooldown_remaining": max(0.0, s.failed_until - now)
+                }
+                for s in sorted(self._states.values(), key=lambda s: s.index)
+            ]
@@ -0,0 +1,518 @@
+"""
+Conversation memory storage for the chat endpoint.
+A chat request only reads and appends the calling user's turns instead of
+rewriting every user. Two backends are available:
+- ConversationLogStore: one append-only JSON-lines log per user
+- SQLiteMemoryStore: a single SQLite database in WAL mode, safe to share
+  between gunicorn workers
+CachedMemoryStore can sit in front of either one to keep hot conversations
+in memory and write new turns behind the request.
+"""
+
+import atexit
+import hashlib
+import json
+import os
+import queue
+import sqlite3
+import threading
+import time
+from collections import OrderedDict
+
+from log_setup import get_logger
+
+try:
+    import fcntl
+except ImportError:  # Windows: the log store's locks then only cover this process
+    fcntl = None
+
+MAX_HISTORY_ENTRIES = 20  # Keep the last 20 entries (10 exchanges) per user
+COMPACT_THRESHOLD = 40    # Rewrite a user's log once it grows past this many lines
+LOCK_STRIPES = 64
+ENTRY_OVERHEAD_BYTES = 64  # Rough per-entry cost of the dict and strings
+
+logger = get_logger('memory_store')
+
+
+def clean_conversation(conversation):
+    """Drop any messages with empty or None content"""
+    return [
+        msg for msg in conversation
+        if isinstance(msg, dict) and (msg.get('content') or '').strip()
+    ]
+
+
+class _StripeLock:
+    """A thread lock plus an flock on a lock file, so other worker processes are kept out too"""
+
+    def __init__(self, path):
+        self.path = path
+        self._thread_lock = threading.Lock()
+        self._fd = None
+        self._pid = None
+
+    def __enter__(self):
+        self._thread_lock.acquire()
+        if fcntl is None:
+            return self
+        try:
+            # flock locks belong to the open file, so a descriptor inherited
+            # through fork would be shared with the parent; open our own
+            if self._pid != os.getpid():
+                self._fd = os.open(self.path, os.O_RDWR | os.O_CREAT, 0o644)
+                self._pid = os.getpid()
+            fcntl.flock(self._fd, fcntl.LOCK_EX)
+        except BaseException:
+            self._thread_lock.release()
+            raise
+        return self
+
+    def __exit__(self, *exc_info):
+        if fcntl is not None:
+            fcntl.flock(self._fd, fcntl.LOCK_UN)
+        self._thread_lock.release()
+
+
+class ConversationLogStore:
+    """Stores each user's conversation as a JSON-lines log that is only appended to.
+
+    Logs are compacted back down to the last `max_entries` entries by a
+    background thread once they grow past `compact_threshold` lines.
+    """
+
+    def __init__(self, directory, legacy_file=None, max_entries=MAX_HISTORY_ENTRIES,
+                 compact_threshold=COMPACT_THRESHOLD):
+        self.directory = directory
+        self.max_entries = max_entries
+        self.compact_threshold = max(compact_threshold, max_entries)
+        os.makedirs(directory, exist_ok=True)
+
+        # Striped locks keep appends and compaction of the same user apart,
+        # across threads and worker processes, without a lock per user
+        self._locks = [_StripeLock(os.path.join(directory, f'.lock-{i}')) for i in range(LOCK_STRIPES)]
+        # user_id -> average bytes per line at the last full read; the file
+        # size divided by it estimates the line count whichever worker wrote
+        self._line_bytes = {}
+        self._compact_queue = queue.Queue()
+        self._compacting = set()
+        self._compactor = threading.Thread(target=self._compact_loop, name='memory-compactor', daemon=True)
+        self._compactor.start()
+
+        if legacy_file:
+            self._import_legacy_file(legacy_file)
+
+    def _digest(self, user_id):
+        return hashlib.sha1(str(user_id).encode('utf-8')).hexdigest()
+
+    def _path(self, user_id):
+        return os.path.join(self.directory, self._digest(user_id) + '.jsonl')
+
+    def _lock(self, user_id):
+        # Not hash(): string hashes differ between processes
+        return self._locks[int(self._digest(user_id)[:8], 16) % LOCK_STRIPES]
+
+    def _read_entries(self, user_id):
+        """Read every entry in the user's log, skipping lines that can't be parsed"""
+        path = self._path(user_id)
+        entries = []
+        lines = 0
+        try:
+            with open(path, 'r', encoding='utf-8') as f:
+                for line in f:
+                    lines += 1
+                    try:
+                        entries.append(json.loads(line))
+                    except ValueError:
+                        # A torn write from a crashed process; compaction drops it
+                        continue
+                if lines:
+                    self._line_bytes[user_id] = os.fstat(f.fileno()).st_size / lines
+        except FileNotFoundError:
+            pass
+        return entries, lines
+
+    def get_conversation(self, user_id):
+        """Return the user's recent conversation (oldest first)"""
+        with self._lock(user_id):
+            entries, _ = self._read_entries(user_id)
+        return clean_conversation(entries)[-self.max_entries:]
+
+    def append_turns(self, user_id, entries):
+        """Append new entries to the user's log"""
+        entries = clean_conversation(entries)
+        if not entries:
+            return
+        payload = ''.join(
+            json.dumps({"role": e.get("role"), "content": e["content"]}, ensure_ascii=False) + '\n'
+            for e in entries
+        )
+        with self._lock(user_id):
+            with open(self._path(user_id), 'a', encoding='utf-8') as f:
+                f.write(payload)
+                f.flush()
+                size = os.fstat(f.fileno()).st_size
+        line_bytes = self._line_bytes.get(user_id) or len(payload.encode('utf-8')) / len(entries)
+        if size > line_bytes * self.compact_threshold:
+            self._schedule_compaction(user_id)
+
+    def append_many(self, batches):
+        """Append entries for several users ({user_id: [entries]})"""
+        for user_id, entries in batches.items():
+            self.append_turns(user_id, entries)
+
+    def _schedule_compaction(self, user_id):
+        if user_id in self._compacting:
+            return
+        self._compacting.add(user_id)
+        self._compact_queue.put(user_id)
+
+    def _compact_loop(self):
+        while True:
+            user_id = self._compact_queue.get()
+            try:
+                self.compact(user_id)
+            except Exception as e:
+                logger.exception(f"[Memory] Error compacting log for {user_id}: {e}")
+            finally:
+                self._compacting.discard(user_id)
+
+    def compact(self, user_id):
+        """Rewrite the user's log with only the last `max_entries` entries"""
+        path = self._path(user_id)
+        with self._lock(user_id):
+            entries, lines = self._read_entries(user_id)
+            if lines <= self.max_entries:
+                return  # another worker compacted it already
+            entries = clean_conversation(entries)[-self.max_entries:]
+            self._write_entries(path, entries)
+
+    def _write_entries(self, path, entries):
+        # Write to temporary file first, then rename (atomic operation); the
+        # PID keeps workers from sharing a temp file
+        temp_file = f"{path}.{os.getpid()}.tmp"
+        try:
+            with open(temp_file, 'w', encoding='utf-8') as f:
+                for e in entries:
+                    f.write(json.dumps({"role": e.get("role"), "content": e["content"]}, ensure_ascii=False) + '\n')
+            os.replace(temp_file, path)
+        except Exception:
+            try:
+                os.remove(temp_file)
+            except OSError:
+                pass
+            raise
+
+    def _import_legacy_file(self, legacy_file):
+        """One-time migration from the old single chat_memory.json file"""
+        if not os.path.exists(legacy_file):
+            return
+        try:
+            with open(legacy_file, 'r', encoding='utf-8') as f:
+                data = json.load(f) or {}
+        except Exception as e:
+            logger.warning(f"[Memory] Could not import {legacy_file}: {e}")
+            return
+
+        imported = 0
+        for user_id, conversation in data.items():
+            if not isinstance(conversation, list):
+                continue
+            with self._lock(user_id):
+                # Never overwrite a log that already exists (e.g. another
+                # worker migrated this user first)
+                if os.path.exists(self._path(user_id)):
+                    continue
+                entries = clean_conversation(conversation)[-self.max_entries:]
+                if entries:
+                    self._write_entries(self._path(user_id), entries)
+                    imported += 1
+        try:
+            os.replace(legacy_file, legacy_file + '.migrated')
+        except OSError:
+            pass
+        logger.info(f"[Memory] Imported {imported} user conversations from {legacy_file}")
+
+
+class SQLiteMemoryStore:
+    """Stores conversations as rows in SQLite, indexed by (user_id, seq).
+
+    WAL mode lets readers run alongside a writer, and every append happens in
+    its own transaction so concurrent workers never drop each other's turns.
+    """
+
+    def __init__(self, db_path, legacy_file=None, max_entries=MAX_HISTORY_ENTRIES):
+        self.db_path = db_path
+        self.max_entries = max_entries
+        self._local = threading.local()
+
+        conn = self._connect()
+        conn.execute("PRAGMA journal_mode=WAL")
+        conn.execute(
+            "CREATE TABLE IF NOT EXISTS turns ("
+            " seq INTEGER PRIMARY KEY AUTOINCREMENT,"
+            " user_id TEXT NOT NULL,"
+            " role TEXT NOT NULL,"
+            " content TEXT NOT NULL,"
+            " created_at REAL NOT NULL)"
+        )
+        conn.execute("CREATE INDEX IF NOT EXISTS idx_turns_user_seq ON turns (user_id, seq)")
+
+        if legacy_file:
+            self._import_legacy_file(legacy_file)
+
+    def _connect(self):
+        """Return this thread's connection (sqlite3 connections can't be shared across threads)"""
+        conn = getattr(self._local, 'conn', None)
+        if conn is None:
+            # isolation_level=None: we issue BEGIN/COMMIT ourselves
+            conn = sqlite3.connect(self.db_path, timeout=10, isolation_level=None)
+            conn.execute("PRAGMA synchronous=NORMAL")
+            conn.execute("PRAGMA busy_timeout=10000")
+            self._local.conn = conn
+        return conn
+
+    def get_conversation(self, user_id):
+        """Return the user's recent conversation (oldest first)"""
+        rows = self._connect().execute(
+            "SELECT role, content FROM turns WHERE user_id = ? ORDER BY seq DESC LIMIT ?",
+            (str(user_id), self.max_entries)
+        ).fetchall()
+        return [{"role": role, "content": content} for role, content in reversed(rows)]
+
+    def append_turns(self, user_id, entries):
+        """Insert new entries and trim the user's history in one transaction"""
+        entries = clean_conversation(entries)
+        if not entries:
+            return
+        conn = self._connect()
+        conn.execute("BEGIN IMMEDIATE")
+        try:
+            self._insert(conn, str(user_id), entries)
+            conn.execute("COMMIT")
+        except Exception:
+            conn.execute("ROLLBACK")
+            raise
+
+    def append_many(self, batches):
+        """Insert entries for several users ({user_id: [entries]}) in one transaction"""
+        batches = {str(u): clean_conversation(e) for u, e in batches.items()}
+        batches = {u: e for u, e in batches.items() if e}
+        if not batches:
+            return
+        conn = self._connect()
+        conn.execute("BEGIN IMMEDIATE")
+        try:
+            for user_id, entries in batches.items():
+                self._insert(conn, user_id, entries)
+            conn.execute("COMMIT")
+        except Exception:
+            conn.execute("ROLLBACK")
+            raise
+
+    def _insert(self, conn, user_id, entries):
+        now = time.time()
+        conn.executemany(
+            "INSERT INTO turns (user_id, role, content, created_at) VALUES (?, ?, ?, ?)",
+            [(user_id, e.get("role") or "user", e["content"], now) for e in entries]
+        )
+        # Keep only the newest max_entries rows for this user
+        conn.execute(
+            "DELETE FROM turns WHERE user_id = ? AND seq < ("
+            " SELECT seq FROM turns WHERE user_id = ? ORDER BY seq DESC LIMIT 1 OFFSET ?)",
+            (user_id, user_id, self.max_entries - 1)
+        )
+
+    def _import_legacy_file(self, legacy_file):
+        """One-time migration from the old single chat_memory.json file"""
+        if not os.path.exists(legacy_file):
+            return
+        try:
+            with open(legacy_file, 'r', encoding='utf-8') as f:
+                data = json.load(f) or {}
+        except Exception as e:
+            logger.warning(f"[Memory] Could not import {legacy_file}: {e}")
+            return
+
+        conn = self._connect()
+        imported = 0
+        conn.execute("BEGIN IMMEDIATE")
+        try:
+            for user_id, conversation in data.items():
+                if not isinstance(conversation, list):
+                    continue
+                # Never overwrite history that already exists (e.g. another
+                # worker migrated this user first)
+                if conn.execute("SELECT 1 FROM turns WHERE user_id = ? LIMIT 1", (str(user_id),)).fetchone():
+                    continue
+                entries = clean_conversation(conversation)[-self.max_entries:]
+                if entries:
+                    self._insert(conn, str(user_id), entries)
+                    imported += 1
+            conn.execute("COMMIT")
+        except Exception as e:
+            conn.execute("ROLLBACK")
+            logger.warning(f"[Memory] Could not import {legacy_file}: {e}")
+            return
+        try:
+            os.replace(legacy_file, legacy_file + '.migrated')
+        except OSError:
+            pass
+        logger.info(f"[Memory] Imported {imported} user conversations from {legacy_file}")
+
+
+class CachedMemoryStore:
+    """Bounded LRU of hot conversations in front of another store.
+
+    Reads for cached users never touch disk. New turns are applied to the
+    cached copy right away and written to the backing store in batches by a
+    background thread, every `flush_interval` seconds or as soon as
+    `dirty_threshold` entries are waiting, and once more at shutdown.
+
+    Turns are only durable once flushed: a hard kill (SIGKILL, OOM, power
+    loss) loses up to `flush_interval` seconds of them. Each process has its
+    own cache and never re-reads a cached user, so with several workers a
+    user whose requests alternate between them sees stale context for as long
+    as the entry stays cached; app.py only enables it for a single worker.
+    """
+
+    def __init__(self, backing, max_users=1000, max_bytes=8 * 1024 * 1024,
+                 flush_interval=2.0, dirty_threshold=50):
+        self.backing = backing
+        self.max_entries = backing.max_entries
+        self.max_users = max_users
+        self.max_bytes = max_bytes
+        self.flush_interval = flush_interval
+        self.dirty_threshold = dirty_threshold
+
+        self._cache = OrderedDict()  # user_id -> (entries, approx_bytes), oldest first
+        self._bytes = 0
+        self._pending = {}  # user_id -> entries not yet written to the backing store
+        self._pending_count = 0
+        self._flushing = {}  # the batch being written right now, still pinned in the cache
+        self._lock = threading.Lock()
+        self._flush_lock = threading.Lock()
+        self._wake = threading.Event()
+        self._closed = False
+
+        self._flusher = threading.Thread(target=self._flush_loop, name='memory-flusher', daemon=True)
+        self._flusher.start()
+        atexit.register(self.close)
+
+    @staticmethod
+    def _size(entries):
+        return sum(len(e["content"]) + len(e.get("role") or '') + ENTRY_OVERHEAD_BYTES for e in entries)
+
+    def _put(self, user_id, entries):
+        """Insert or replace a cached conversation (caller holds the lock)"""
+        old = self._cache.pop(user_id, None)
+        if old:
+            self._bytes -= old[1]
+        size = self._size(entries)
+        self._cache[user_id] = (entries, size)
+        self._bytes += size
+        self._evict()
+
+    def _evict(self):
+        """Drop least recently used conversations until within limits.
+
+        Users with unflushed turns (queued or being written) are kept, so a
+        read never reloads a conversation the backing store doesn't have yet.
+        """
+        if len(self._cache) <= self.max_users and self._bytes <= self.max_bytes:
+            return
+        for user_id in list(self._cache):
+            if len(self._cache) <= self.max_users and self._bytes <= self.max_bytes:
+                break
+            if user_id in self._pending or user_id in self._flushing:
+                continue
+            _, size = self._cache.pop(user_id)
+            self._bytes -= size
+
+    def get_conversation(self, user_id):
+        """Return the user's recent conversation (oldest first)"""
+        with self._lock:
+            cached = self._cache.get(user_id)
+            if cached is not None:
+                self._cache.move_to_end(user_id)
+                return list(cached[0])
+
+        entries = self.backing.get_conversation(user_id)
+
+        with self._lock:
+            # Another thread may have loaded (and appended to) it meanwhile
+            cached = self._cache.get(user_id)
+            if cached is not None:
+                self._cache.move_to_end(user_id)
+                return list(cached[0])
+            self._put(user_id, entries)
+        return list(entries)
+
+    def append_turns(self, user_id, entries):
+        """Apply new entries to the cached conversation and queue them for writing"""
+        entries = clean_conversation(entries)
+        if not entries:
+            return
+        with self._lock:
+            cached = self._cache.get(user_id)
+        if cached is None:
+            self.get_conversation(user_id)
+
+        with self._lock:
+            cached = self._cache.get(user_id)
+            current = cached[0] if cached else []
+            self._pending.setdefault(user_id, []).extend(entries)
+            self._pending_count += len(entries)
+            self._put(user_id, (current + entries)[-self.max_entries:])
+            if self._pending_count >= self.dirty_threshold:
+                self._wake.set()
+
+    def append_many(self, batches):
+        """Apply entries for several users ({user_id: [entries]})"""
+        for user_id, entries in batches.items():
+            self.append_turns(user_id, entries)
+
+    def flush(self):
+        """Write every pending entry to the backing store"""
+        with self._flush_lock:
+            with self._lock:
+                batch = self._flushing = self._pending
+                self._pending = {}
+                self._pending_count = 0
+            if not batch:
+                return
+            try:
+                self.backing.append_many(batch)
+            except Exception as e:
+                logger.exception(f"[Memory] Error flushing {len(batch)} conversations: {e}")
+                # Put the batch back ahead of anything queued since
+                with self._lock:
+                    for user_id, entries in batch.items():
+                        self._pending[user_id] = entries + self._pending.get(user_id, [])
+                        self._pending_count += len(entries)
+                    self._flushing = {}
+                return
+            # Committed: conversations kept only because they were dirty can go now
+            with self._lock:
+                self._flushing = {}
+                self._evict()
+
+    def _flush_loop(self):
+        while not self._closed:
+            self._wake.wait(self.flush_interval)
+            self._wake.clear()
+            self.flush()
+
+    def close(self):
+        """Stop the background flusher and write anything still pending"""
+        self._closed = True
+        self._wake.set()
+        self.flush()
+
+
+def create_memory_store(backend, location, legacy_file=None):
+    """Build the configured memory backend ('sqlite' or 'log')"""
+    if backend == 'log':
+        return ConversationLogStore(location, legacy_file=legacy_file)
+    if backend != 'sqlite':
+        logger.warning(f"[Memory] Unknown memory backend '{backend}', using sqlite")
+    return SQLiteMemoryStore(location, legacy_file=legacy_file)
@@ -13,13 +13,21 @@ except Exception:
     REQUESTS_AVAILABLE = False
     print("[NetlifyFunction] WARNING: 'requests' package not available. Network calls will be disabled until requirements are installed.")
 
+# Connections to openrouter.ai are kept open at module level, so warm
+# invocations of this function reuse them instead of doing a new TCP and TLS
+# handshake every time. Tunable through the environment.
+HTTP_POOL_SIZE = int(os.getenv('HTTP_POOL_SIZE', '4'))  # kept-alive connections per host
+HTTP_CONNECT_TIMEOUT = float(os.getenv('HTTP_CONNECT_TIMEOUT', '3.05'))  # seconds to connect; reads use `timeout`
+
 # Provide a minimal urllib fallback so the function can still make HTTP POST
 # requests when the `requests` package isn't available (common in some
 # Netlify dev setups). The rest of the code uses `http_post` instead of
 # calling `requests.post` directly.
 if not REQUESTS_AVAILABLE:
-    import urllib.request
-    import urllib.error
+    import http.client
+    import socket
+    import threading
+    import urllib.parse
 
     class SimpleResponse:
         def __init__(self, status_code, text):
@@ -36,28 +44,69 @@ if not REQUESTS_AVAILABLE:
             except Exception:
                 return {}
 
+    # One persistent http.client connection per (scheme, host), the
+    # standard-library equivalent of the requests session below
+    _connections = {}
+    _connections_lock = threading.Lock()
+
+    def _open_connection(scheme, host, timeout):
+        connection_class = http.client.HTTPSConnection if scheme == 'https' else http.client.HTTPConnection
+        conn = connection_class(host, timeout=HTTP_CONNECT_TIMEOUT)
+        conn.connect()
+        conn.sock.settimeout(timeout)
+        conn.sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        return conn
+
     def http_post(url, headers, json_payload, timeout=15):
         data = json.dumps(json_payload).encode('utf-8')
-        req = urllib.request.Request(url, data=data, method='POST')
-        for k, v in (headers or {}).items():
-            req.add_header(k, v)
-        try:
-            with urllib.request.urlopen(req, timeout=timeout) as resp:
-                body = resp.read().decode('utf-8')
-                return SimpleResponse(resp.getcode(), body)
-        except urllib.error.HTTPError as he:
+        parts = urllib.parse.urlsplit(url)
+        path = parts.path + ('?' + parts.query if parts.query else '')
+        request_headers = {'Content-Type': 'application/json', 'Connection': 'keep-alive'}
+        request_headers.update(headers or {})
+        key = (parts.scheme, parts.netloc)
+        with _connections_lock:
+            conn = _connections.pop(key, None)
+        # A kept-alive connection may have been closed by the server while the
+        # container was frozen; then retry once on a fresh one
+        for _ in range(2):
+            fresh = conn is None
             try:
-                body = he.read().decode('utf-8')
-            except Exception:
-                body = str(he)
-            return SimpleResponse(getattr(he, 'code', 500), body)
-        except Exception as e:
-            return SimpleResponse(0, str(e))
+                if fresh:
+                    conn = _open_connection(parts.scheme, parts.netloc, timeout)
+                elif conn.sock is not None:
+                    conn.sock.settimeout(timeout)
+                conn.request('POST', path, body=data, headers=request_headers)
+                resp = conn.getresponse()
+                body = resp.read().decode('utf-8')
+                if resp.will_close:
+                    conn.close()
+                else:
+                    with _connections_lock:
+                        _connections[key] = conn
+                return SimpleResponse(resp.status, body)
+            except (http.client.HTTPException, ConnectionError) as e:
+                if conn is not None:
+                    conn.close()
+                conn = None
+                if fresh:
+                    return SimpleResponse(0, str(e))
+            except Exception as e:
+                if conn is not None:
+                    conn.close()
+                return SimpleResponse(0, str(e))
 else:
+    from requests.adapters import HTTPAdapter
+
+    # Module-level session: its connection pool survives across warm invocations
+    _session = requests.Session()
+    _adapter = HTTPAdapter(pool_connections=2, pool_maxsize=HTTP_POOL_SIZE, max_retries=0)
+    _session.mount('https://', _adapter)
+    _session.mount('http://', _adapter)
+
     # when requests is available, use it via a small adapter function for
     # consistent return shape
     def http_post(url, headers, json_payload, timeout=15):
-        resp = requests.post(url, headers=headers, json=json_payload, timeout=timeout)
+        resp = _session.post(url, headers=headers, json=json_payload, timeout=(HTTP_CONNECT_TIMEOUT, timeout))
         class R:
             def __init__(self, resp):
                 self._resp = resp
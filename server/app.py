@@ -1,29 +1,43 @@
-from flask import Flask, request, jsonify, render_template, send_from_directory
+from flask import Flask, request, jsonify, render_template, send_from_directory, Response, stream_with_context, g
 from flask_cors import CORS
 try:
     from openai import OpenAI
+    import httpx  # installed with openai; used for the shared connection pool
     openai_available = True
 except Exception as e:
     # Don't crash if the openai package isn't installed or import fails.
     OpenAI = None
+    httpx = None
     openai_available = False
     print("Warning: openai package not available:", e)
 import time
-import traceback
+import threading
+import hashlib
 import json
 import os
 import sys
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
 
 # Import fallback response system
 # Handle both local and containerized environments
 sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
 
-try:
-    from fallback_responses import get_fallback_response
-except ImportError:
-    # Fallback if not found
-    def get_fallback_response(message, voice, context):
-        return {"reply": "I'm having some connectivity issues right now, but I'm still here to chat!"}
+from fallback_responses import BACKEND_VOICE_MAP, get_fallback_response, get_intent_reply
+
+from memory_store import create_memory_store, CachedMemoryStore
+from key_pool import KeyPool, is_rate_limit_error, key_error_kind, parse_rate_limit_headers
+from response_cache import ResponseCache
+from fuzzy_match import FuzzyResponseIndex
+from intent_classifier import create_intent_classifier, IntentRouter, parse_thresholds
+from timing import StageTimer, new_request_id, span
+from log_setup import get_logger, gunicorn_workers
+from metrics import Registry
+from voice_sessions import VoiceSessionStore
+from voice_events import VoiceEventHub
+from shared_state import create_shared_state
+from dedup_cache import DuplicateMessageCache
+from single_flight import SingleFlight
+from context_window import ContextWindow
 
 # Configure Flask to serve frontend + backend
 app = Flask(__name__, static_folder='static', static_url_path='')
@@ -54,50 +68,154 @@ if not openrouter_keys:
 
 print(f"Startup: openai_available={openai_available}, openrouter_keys_count={len(openrouter_keys)}")
 
-def get_client(index):
+OPENROUTER_BASE_URL = "https://openrouter.ai/api/v1"
+
+# One OpenAI client per key, all sharing a single keep-alive connection pool,
+# so a chat message reuses an open TLS connection instead of handshaking again.
+# The pool is created lazily so each gunicorn worker gets its own after fork.
+_client_cache = {}  # maps actual API key string -> OpenAI client
+_client_lock = threading.RLock()
+_http_client = None
+
+def _get_http_client():
+    global _http_client
+    if _http_client is None:
+        _http_client = httpx.Client(
+            limits=httpx.Limits(max_connections=32, max_keepalive_connections=16, keepalive_expiry=120),
+            timeout=httpx.Timeout(30.0, connect=5.0)
+        )
+    return _http_client
+
+def get_client_for_key(api_key):
+    """Return the cached client for this key, creating it on first use"""
     if not openai_available:
         raise RuntimeError("OpenAI/OpenRouter client not available (openai package missing)")
-    if index < 0 or index >= len(openrouter_keys):
-        raise IndexError("OpenRouter key index out of range")
-    client = OpenAI(api_key=openrouter_keys[index], base_url="https://openrouter.ai/api/v1")
+    client = _client_cache.get(api_key)
+    if client is None:
+        with _client_lock:
+            client = _client_cache.get(api_key)
+            if client is None:
+                client = OpenAI(api_key=api_key, base_url=OPENROUTER_BASE_URL, http_client=_get_http_client())
+                _client_cache[api_key] = client
     return client
 
-# Per-key failure tracking to avoid immediately retrying recently-failed keys
-KEY_COOLDOWN_SECONDS = 60
-failed_keys = {}  # maps actual API key string -> failed_until (timestamp)
-
-def rotate_keys_to_front(succeeded_index):
-    """Move the succeeded key to the front of the list"""
-    global openrouter_keys
-    if succeeded_index < 0 or succeeded_index >= len(openrouter_keys):
-        print(f"[Key Rotation] Invalid index {succeeded_index}, skipping rotation")
-        return
-
-    key = openrouter_keys.pop(succeeded_index)
-    openrouter_keys.insert(0, key)
-    print(f"[Key Rotation] Rotated key to front")
+def invalidate_clients(keep=None):
+    """Drop cached clients, except those for keys in `keep`.
 
-def rotate_key_to_end(failed_index):
-    """Move the failed key to the end of the list"""
-    global openrouter_keys
-    if failed_index < 0 or failed_index >= len(openrouter_keys):
-        print(f"[Key Rotation] Invalid index {failed_index}, skipping rotation")
-        return
+    The shared connection pool stays open; only the per-key wrappers go.
+    """
+    with _client_lock:
+        for key in list(_client_cache):
+            if keep is None or key not in keep:
+                del _client_cache[key]
 
-    key = openrouter_keys.pop(failed_index)
-    openrouter_keys.append(key)
-    print(f"[Key Rotation] Moved rate-limited key to end of list")
+# Per-key failure tracking to avoid immediately retrying recently-failed keys.
+# Requests pick keys by value from the pool, so concurrent requests never
+# shift each other's positions.
+KEY_COOLDOWN_SECONDS = 60
+# A rate-limited (429/402) key rests this long, doubling with each rate limit
+# in a row up to KEY_MAX_COOLDOWN_SECONDS; a success resets it
+KEY_RATE_LIMIT_COOLDOWN_SECONDS = int(os.getenv('KEY_RATE_LIMIT_COOLDOWN_SECONDS', '120'))
+KEY_MAX_COOLDOWN_SECONDS = int(os.getenv('KEY_MAX_COOLDOWN_SECONDS', '3600'))
+key_pool = KeyPool(
+    openrouter_keys,
+    cooldown=KEY_COOLDOWN_SECONDS,
+    rate_limit_cooldown=KEY_RATE_LIMIT_COOLDOWN_SECONDS,
+    max_cooldown=KEY_MAX_COOLDOWN_SECONDS
+)
+# Called with the new key list whenever the keys change (asgi_app drops its async clients)
+key_change_listeners = []
+
+def set_openrouter_keys(keys):
+    """Replace the configured keys at runtime.
+
+    Updates the list in place (other modules hold a reference to it), the
+    pool, and drops cached clients for keys that are gone, so a key that was
+    rotated out is never used again even if the number of keys is unchanged.
+    """
+    keys = [k.strip() for k in keys if (k or '').strip()]
+    openrouter_keys[:] = keys
+    key_pool.set_keys(keys)
+    invalidate_clients(keep=keys)
+    for listener in key_change_listeners:
+        listener(keys)
+
+# Hedged requests: if a key hasn't answered within HEDGE_DELAY_SECONDS, fire
+# the same request on the next healthy key and take whichever answers first.
+# 0 (default) keeps the strictly sequential behaviour.
+HEDGE_DELAY_SECONDS = float(os.getenv('HEDGE_DELAY_SECONDS', '0'))
+HEDGE_MAX_PARALLEL = int(os.getenv('HEDGE_MAX_PARALLEL', '2'))
+_hedge_executor = ThreadPoolExecutor(max_workers=16, thread_name_prefix='hedge') if HEDGE_DELAY_SECONDS > 0 else None
+
+# Batch chat: one user's items are answered in order, different users'
+# items in parallel, at most CHAT_BATCH_CONCURRENCY at a time across all batches
+CHAT_BATCH_MAX_ITEMS = int(os.getenv('CHAT_BATCH_MAX_ITEMS', '50'))
+CHAT_BATCH_CONCURRENCY = int(os.getenv('CHAT_BATCH_CONCURRENCY', '4'))
+_batch_executor = ThreadPoolExecutor(max_workers=CHAT_BATCH_CONCURRENCY, thread_name_prefix='chat-batch')
+
+# Worker processes serving the app. gunicorn reads the same variable (see
+# Procfile); per-process caches are only on by default when there is one.
+# A gunicorn --workers on the command line wins, since that is what runs
+WEB_CONCURRENCY = int(os.getenv('WEB_CONCURRENCY', '1'))
+_gunicorn_workers = gunicorn_workers()
+if _gunicorn_workers and _gunicorn_workers != WEB_CONCURRENCY:
+    print(f"Warning: gunicorn runs {_gunicorn_workers} workers but WEB_CONCURRENCY is {WEB_CONCURRENCY}; "
+          f"using {_gunicorn_workers}. Set WEB_CONCURRENCY instead of --workers.")
+    WEB_CONCURRENCY = _gunicorn_workers
 
 MEMORY_FILE = 'chat_memory.json'
+# Conversation memory backend: 'sqlite' (default, safe across gunicorn workers)
+# or 'log' (one append-only JSON-lines file per user under MEMORY_DIR)
+MEMORY_BACKEND = os.getenv('MEMORY_BACKEND', 'sqlite').strip().lower()
+MEMORY_DB = os.getenv('MEMORY_DB', 'chat_memory.db')
+MEMORY_DIR = os.getenv('MEMORY_DIR', 'chat_memory')
+# In-process LRU of hot conversations with write-behind (MEMORY_CACHE_USERS=0 disables it).
+# Off by default with several workers: other workers' cached copies would go stale
+MEMORY_CACHE_USERS = int(os.getenv('MEMORY_CACHE_USERS', '1000' if WEB_CONCURRENCY == 1 else '0'))
+MEMORY_CACHE_BYTES = int(os.getenv('MEMORY_CACHE_BYTES', str(8 * 1024 * 1024)))
+MEMORY_FLUSH_INTERVAL = float(os.getenv('MEMORY_FLUSH_INTERVAL', '2'))
+
+# State every worker sees: duplicate messages, voice sessions and key cooldowns.
+# 'sqlite' (one file shared by the workers on this machine), 'redis' (REDIS_URL,
+# shared across machines) or 'local' (this process only; the default with one
+# worker, where sharing would only add a few SQLite round trips per reply)
+SHARED_STATE_BACKEND = os.getenv('SHARED_STATE', 'local' if WEB_CONCURRENCY == 1 else 'sqlite').strip().lower()
+SHARED_STATE_DB = os.getenv('SHARED_STATE_DB', 'shared_state.db')
+REDIS_URL = os.getenv('REDIS_URL', 'redis://localhost:6379/0')
+KEY_STATE_SYNC_INTERVAL = 1.0  # seconds between pulls of other workers' key cooldowns
+shared_state = create_shared_state(
+    SHARED_STATE_BACKEND,
+    REDIS_URL if SHARED_STATE_BACKEND == 'redis' else SHARED_STATE_DB
+)
 
 # Duplicate prevention
 DUPLICATE_WINDOW_SECONDS = 15
-message_cache = {}  # Format: {user_id: {'text': normalized_message, 'time': timestamp, 'response': reply}}
+MESSAGE_CACHE_USERS = 1000  # most users remembered at once
+# Per user: {'text': normalized_message, 'time': timestamp, 'response': reply}
+message_cache = DuplicateMessageCache(DUPLICATE_WINDOW_SECONDS, max_users=MESSAGE_CACHE_USERS)
+# (user_id, normalized_message) -> reply still being produced, so a resend
+# that arrives before it is saved waits for it instead of going upstream again
+pending_replies = SingleFlight()
 
 # Backend voice session management
-voice_sessions = {}  # Format: {user_id: {"listening_until": timestamp, "last_input": timestamp, "auto_listen": True}}
 VOICE_SESSION_TIMEOUT = 25  # seconds of silence before AI asks "are you still there?"
 AUTO_LISTEN_DURATION = 120  # Keep listening for 2 minutes after response
+SILENCE_PROMPT_GRACE = 5  # seconds to answer the silence prompt before the session ends
+VOICE_SESSION_MAX = int(os.getenv('VOICE_SESSION_MAX', '10000'))  # oldest sessions are dropped past this
+VOICE_EVENTS_KEEPALIVE = 15  # seconds between keepalive comments on /api/voice/events
+# Pushes session events to tabs listening on /api/voice/events. Only asgi_app.py
+# serves that stream (an open stream would tie up a sync worker here), and only
+# with one worker: events are published by the process that handled the chat,
+# which may not be the one holding the tab's stream. Otherwise tabs poll.
+VOICE_EVENTS_ENABLED = WEB_CONCURRENCY == 1
+voice_events = VoiceEventHub()
+# Sessions expire AUTO_LISTEN_DURATION after the last reply, so abandoned tabs don't pile up
+voice_sessions = VoiceSessionStore(
+    AUTO_LISTEN_DURATION,
+    max_sessions=VOICE_SESSION_MAX,
+    on_expire=lambda user_id: _publish_session_ended(user_id, 'expired'),
+    shared=shared_state if shared_state.shared else None
+)
 EXIT_PHRASES = ['bye', 'goodbye', 'see you', 'shut up', 'stop listening', 'close mic']
 
 # Personality prompts by voice
@@ -109,6 +227,11 @@ PERSONALITIES = {
     "Alecx": "You are Alecx, a thoughtful and calm person. Your voice is soothing, reassuring, and always patient, helping users feel relaxed and confident."
 }
 
+# Fits history into CONTEXT_TOKEN_BUDGET; prompt token counts are kept per voice
+context_window = ContextWindow(PERSONALITIES)
+
+ALLOWED_VOICES = ['Anna', 'Irish', 'Alexa', 'Jak', 'Alecx']
+
 # Custom knowledge base
 CUSTOM_RESPONSES = {
     "what is your name?": "I'm Bzik AI, your friendly chatbot assistant!",
@@ -171,91 +294,126 @@ def _normalize(text: str) -> str:
 # Rebuild normalized lookup
 NORMALIZED_CUSTOM_RESPONSES = { _normalize(k): v for k, v in CUSTOM_RESPONSES.items() }
 
-def load_memory():
-    if os.path.exists(MEMORY_FILE):
-        try:
-            with open(MEMORY_FILE, 'r', encoding='utf-8') as f:
-                data = json.load(f)
-                if not data:
-                    return {}
-                # Clean all conversations: remove any messages with empty or None content
-                cleaned_data = {}
-                for user_id, conversation in data.items():
-                    if isinstance(conversation, list):
-                        cleaned_conversation = [msg for msg in conversation if msg.get('content', '').strip()]
-                        if cleaned_conversation:
-                            cleaned_data[user_id] = cleaned_conversation
-                return cleaned_data
-        except json.JSONDecodeError as e:
-            print(f"[Memory] Corrupted JSON file: {e}, starting fresh")
-            # Delete corrupted file
-            try:
-                os.remove(MEMORY_FILE)
-            except:
-                pass
-            return {}
-        except Exception as e:
-            print(f"[Memory] Error loading memory: {e}")
-            return {}
-    return {}
-
-def save_memory(memory):
-    try:
-        # Write to temporary file first, then rename (atomic operation)
-        temp_file = MEMORY_FILE + '.tmp'
-        with open(temp_file, 'w', encoding='utf-8') as f:
-            json.dump(memory, f, indent=4, ensure_ascii=False)
-        # Atomic rename (overwrites existing file)
-        os.replace(temp_file, MEMORY_FILE)
-        print(f"[Memory] Saved {len(memory)} user conversations")
-    except Exception as e:
-        print(f"[Memory] Error saving memory: {e}")
-        traceback.print_exc()
-        # Ensure temp file doesn't exist if save failed
-        try:
-            os.remove(MEMORY_FILE + '.tmp')
-        except:
-            pass
+# Fuzzy matcher over the same keys, so rewordings like "who's your boss" or
+# "what is ur name" are answered locally too (1.0 = exact matches only)
+CUSTOM_MATCH_THRESHOLD = float(os.getenv('CUSTOM_MATCH_THRESHOLD', '0.8'))
+custom_response_index = FuzzyResponseIndex(NORMALIZED_CUSTOM_RESPONSES, _normalize, threshold=CUSTOM_MATCH_THRESHOLD)
+
+def match_custom_response(message):
+    """Return the canned reply for this message, or None"""
+    match = custom_response_index.match(message)
+    if match is None:
+        return None
+    reply, score, question = match
+    log_debug(f"[Custom Response] Using custom response for message: {message} (matched '{question}', score {score:.2f})")
+    return reply
+
+# Local small-talk classifier: other wordings of greetings, "how are you",
+# thanks, goodbyes and help requests get a fallback reply instead of an API
+# call when it is at least INTENT_THRESHOLD sure (INTENT_CLASSIFIER=off disables it)
+INTENT_CLASSIFIER = os.getenv('INTENT_CLASSIFIER', 'hashed')
+INTENT_MODEL_PATH = os.getenv('INTENT_MODEL_PATH', '')  # trained at startup when unset or missing
+INTENT_THRESHOLD = float(os.getenv('INTENT_THRESHOLD', '0.85'))
+INTENT_THRESHOLDS = parse_thresholds(os.getenv('INTENT_THRESHOLDS', ''))  # e.g. "greeting=0.7,goodbye=0.9"
+INTENT_MAX_WORDS = int(os.getenv('INTENT_MAX_WORDS', '8'))
+intent_classifier = create_intent_classifier(INTENT_CLASSIFIER, _normalize, INTENT_MODEL_PATH)
+intent_router = IntentRouter(
+    intent_classifier,
+    threshold=INTENT_THRESHOLD,
+    thresholds=INTENT_THRESHOLDS,
+    max_words=INTENT_MAX_WORDS
+) if intent_classifier else None
+
+# Cross-user cache of API replies, keyed on normalized message, voice and the
+# last couple of turns (RESPONSE_CACHE_SIZE=0 disables it). With
+# RESPONSE_CACHE_SIMILARITY > 0, near-identical messages match too.
+RESPONSE_CACHE_SIZE = int(os.getenv('RESPONSE_CACHE_SIZE', '2000'))
+RESPONSE_CACHE_TTL = int(os.getenv('RESPONSE_CACHE_TTL', '600'))
+RESPONSE_CACHE_SIMILARITY = float(os.getenv('RESPONSE_CACHE_SIMILARITY', '0'))
+response_cache = ResponseCache(
+    max_entries=RESPONSE_CACHE_SIZE,
+    ttl=RESPONSE_CACHE_TTL,
+    similarity_threshold=RESPONSE_CACHE_SIMILARITY,
+    normalize=_normalize
+) if RESPONSE_CACHE_SIZE > 0 else None
+
+# Per-user conversation store (imports chat_memory.json once if present)
+memory_store = create_memory_store(
+    MEMORY_BACKEND,
+    MEMORY_DB if MEMORY_BACKEND != 'log' else MEMORY_DIR,
+    legacy_file=MEMORY_FILE
+)
+if MEMORY_CACHE_USERS > 0:
+    memory_store = CachedMemoryStore(
+        memory_store,
+        max_users=MEMORY_CACHE_USERS,
+        max_bytes=MEMORY_CACHE_BYTES,
+        flush_interval=MEMORY_FLUSH_INTERVAL
+    )
+
+# Metrics served at /api/metrics
+metrics = Registry()
+chat_latency = metrics.histogram('bzik_chat_latency_seconds', 'End-to-end /api/chat latency', ['voice', 'source'])
+upstream_latency = metrics.histogram('bzik_upstream_latency_seconds', 'OpenRouter completion latency', ['voice'])
+prompt_tokens = metrics.histogram('bzik_prompt_tokens', 'Estimated prompt tokens sent to OpenRouter', ['voice'],
+                                  buckets=(100, 200, 400, 600, 800, 1000, 1500, 2000, 4000))
+memory_latency = metrics.histogram('bzik_memory_store_seconds', 'Conversation memory read/write time', ['op'],
+                                   buckets=(0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 1.0))
+local_replies = metrics.counter('bzik_local_replies_total', 'Replies answered on the fast path', ['intent'])
+duplicate_hits = metrics.counter('bzik_duplicate_hits_total', 'Repeated messages answered from message_cache')
+batch_items = metrics.counter('bzik_batch_items_total', 'Items answered by /api/chat/batch', ['status'])
+coalesced_requests = metrics.counter('bzik_coalesced_requests_total', 'Repeated messages that waited for the in-flight reply')
+fallback_replies = metrics.counter('bzik_fallback_replies_total', 'Replies from the offline fallback responder')
+key_results = metrics.counter('bzik_key_requests_total', 'OpenRouter requests per key and outcome', ['key', 'result'])
+metrics.gauge('bzik_key_cooldown_seconds', 'Seconds until a key leaves cooldown (0 = healthy)',
+              lambda: {(s['key'],): round(s['cooldown_remaining'], 3) for s in key_pool.snapshot()}, ['key'])
+metrics.gauge('bzik_keys_available', 'Keys not in cooldown', lambda: key_pool.available_count())
+metrics.gauge('bzik_response_cache_hits_total', 'Cross-user response cache hits',
+              lambda: response_cache.hits if response_cache else 0, metric_type='counter')
+metrics.gauge('bzik_response_cache_misses_total', 'Cross-user response cache misses',
+              lambda: response_cache.misses if response_cache else 0, metric_type='counter')
+metrics.gauge('bzik_message_cache_entries', 'Users in the duplicate-message cache', lambda: len(message_cache))
+metrics.gauge('bzik_voice_sessions', 'Active voice sessions', lambda: len(voice_sessions))
+
+def record_chat_metrics(voice, source, timer):
+    """Feed one finished /api/chat request's stage timings into the metrics"""
+    chat_latency.observe(timer.total_ms() / 1000, voice, source)
+    if 'memory_load' in timer.stages:
+        memory_latency.observe(timer.stages['memory_load'] / 1000, 'read')
+    if 'memory_save' in timer.stages:
+        memory_latency.observe(timer.stages['memory_save'] / 1000, 'write')
+
+logger = get_logger('app')
 
 def log_debug(msg):
-    """Debug logging to both stdout and file"""
-    print(msg, flush=True)
-    try:
-        with open('api_debug.log', 'a') as f:
-            f.write(msg + '\n')
-    except:
-        pass
+    """Debug logging to stdout and api_debug.log, written by the background log thread"""
+    logger.debug(msg)
 
 # ===== VOICE SESSION MANAGEMENT FUNCTIONS =====
 
 def start_voice_session(user_id):
     """Start a new voice session after AI responds"""
-    current_time = time.time()
-    voice_sessions[user_id] = {
-        "listening_until": current_time + AUTO_LISTEN_DURATION,
-        "last_input": current_time,
-        "silence_start": current_time,
-        "session_active": True,
-        "prompt_sent_at": None
-    }
+    voice_sessions.start(user_id)
     log_debug(f"[Voice] Started session for user {user_id}, listening for {AUTO_LISTEN_DURATION}s")
 
 def update_voice_session(user_id, message_text):
     """Update session on new input (reset silence timer)"""
-    if user_id in voice_sessions:
+    session = voice_sessions.get(user_id)
+    if session is not None:
         current_time = time.time()
-        voice_sessions[user_id]["last_input"] = current_time
-        voice_sessions[user_id]["silence_start"] = current_time
+        session.last_input = current_time
+        session.silence_start = current_time
+        voice_sessions.save(session)
         log_debug(f"[Voice] Updated session for user {user_id}: reset silence timer")
 
 def is_session_silent(user_id):
     """Check if session has been silent for too long"""
-    if user_id not in voice_sessions:
+    session = voice_sessions.get(user_id)
+    if session is None:
         return False
     
     current_time = time.time()
-    session = voice_sessions[user_id]
-    time_since_last_input = current_time - session["last_input"]
+    time_since_last_input = current_time - session.last_input
     
     if time_since_last_input >= VOICE_SESSION_TIMEOUT:
         log_debug(f"[Voice] Session {user_id} silent for {time_since_last_input:.1f}s (timeout: {VOICE_SESSION_TIMEOUT}s)")
@@ -271,17 +429,52 @@ def detect_exit_phrase(message_text):
             return True
     return False
 
-def end_voice_session(user_id):
+def end_voice_session(user_id, reason='ended'):
     """End voice session and close microphone"""
-    if user_id in voice_sessions:
-        del voice_sessions[user_id]
+    if voice_sessions.end(user_id):
         log_debug(f"[Voice] Ended session for user {user_id}")
+        _publish_session_ended(user_id, reason)
+
+def _publish_session_ended(user_id, reason):
+    """Tell listening tabs the session is over; only a silence timeout shows the goodbye message"""
+    payload = {"active": False, "should_listen": False, "reason": reason, "exit_triggered": reason == 'silence'}
+    if reason == 'silence':
+        payload["exit_message"] = "Goodbye! See you soon."
+    voice_events.publish(user_id, 'session_ended', payload)
+
+def _schedule_silence_check(user_id):
+    session = voice_sessions.get(user_id)
+    if session is not None:
+        voice_events.call_at(session.last_input + VOICE_SESSION_TIMEOUT, _on_silence_timeout, user_id, session.last_input)
+
+def _on_silence_timeout(user_id, last_input):
+    """Timer: no input for VOICE_SESSION_TIMEOUT since `last_input`, so push the silence prompt"""
+    session = voice_sessions.get(user_id)
+    # Skip if the user spoke since, or nobody is listening for events (pollers prompt themselves)
+    if session is None or session.last_input != last_input or not voice_events.has_subscribers(user_id):
+        return
+    if not session.prompt_sent_at:
+        session.prompt_sent_at = time.time()
+        voice_sessions.save(session)
+        log_debug(f"[Voice] Silence detected for user {user_id}, pushing prompt")
+        status = get_voice_session_status(user_id)
+        status["silence_prompt"] = "Is there anything I can do?"
+        voice_events.publish(user_id, 'silence_prompt', status)
+    voice_events.call_at(session.prompt_sent_at + SILENCE_PROMPT_GRACE, _on_prompt_ignored, user_id, last_input)
+
+def _on_prompt_ignored(user_id, last_input):
+    session = voice_sessions.get(user_id)
+    if session is None or session.last_input != last_input or not session.prompt_sent_at:
+        return
+    log_debug(f"[Voice] No response to silence prompt for user {user_id}, ending session")
+    end_voice_session(user_id, 'silence')
 
 def get_voice_session_status(user_id):
     """Get current voice session status for frontend"""
     current_time = time.time()
+    session = voice_sessions.get(user_id, current_time)
     
-    if user_id not in voice_sessions:
+    if session is None:
         return {
             "active": False,
             "should_listen": False,
@@ -289,8 +482,7 @@ def get_voice_session_status(user_id):
             "time_remaining": 0
         }
     
-    session = voice_sessions[user_id]
-    listening_until = session.get("listening_until", current_time)
+    listening_until = session.listening_until
     time_remaining = max(0, listening_until - current_time)
     
     return {
@@ -298,89 +490,553 @@ def get_voice_session_status(user_id):
         "should_listen": time_remaining > 0,
         "listening_until": listening_until,
         "time_remaining": time_remaining,
-        "silent_for": current_time - session.get("last_input", current_time)
+        "silent_for": current_time - session.last_input
     }
 
-def get_chat_response(message, voice='friendly', conversation=[]):
+def poll_voice_session(user_id):
+    """Status for a frontend poll: sends the silence prompt, or ends a session that ignored it"""
+    session = voice_sessions.get(user_id)
+    current_time = time.time()
+    
+    # Check if we sent a silence prompt and user hasn't responded in 5 seconds
+    if session is not None and session.prompt_sent_at:
+        time_since_prompt = current_time - session.prompt_sent_at
+        if time_since_prompt > SILENCE_PROMPT_GRACE and is_session_silent(user_id):
+            log_debug(f"[Voice] No response to silence prompt for {time_since_prompt:.1f}s, ending session")
+            end_voice_session(user_id, 'silence')
+            return {
+                "active": False,
+                "should_listen": False,
+                "exit_triggered": True,
+                "exit_message": "Goodbye! See you soon."
+            }
+    
+    # Check for silence and send prompt if needed
+    if is_session_silent(user_id):
+        if not session.prompt_sent_at:
+            # First time detecting silence - send prompt
+            session.prompt_sent_at = current_time
+            voice_sessions.save(session)
+            log_debug(f"[Voice] Silence detected for user {user_id}, sending prompt")
+        
+        status = get_voice_session_status(user_id)
+        status["silence_prompt"] = "Is there anything I can do?"
+        status["next_poll_in"] = _next_voice_check(session, current_time)
+        return status
+    
+    # Reset prompt if user starts talking again
+    if session is not None and session.prompt_sent_at:
+        session.prompt_sent_at = None
+        voice_sessions.save(session)
+        log_debug("[Voice] User started talking again, resetting silence prompt")
+    
+    # Get current status
+    status = get_voice_session_status(user_id)
+    if session is not None:
+        status["next_poll_in"] = _next_voice_check(session, current_time)
+    return status
+
+def _next_voice_check(session, now):
+    """Seconds until polling can find something new: the silence prompt, the
+    end of its grace period or the end of the listening window. Nothing else
+    changes a session except the tab's own chat messages, so pollers wait
+    this long instead of asking every 2 seconds."""
+    if session.prompt_sent_at:
+        due = session.prompt_sent_at + SILENCE_PROMPT_GRACE
+    else:
+        due = session.last_input + VOICE_SESSION_TIMEOUT
+    return round(max(0.0, min(due, session.listening_until) - now) + 0.25, 2)
+
+def _request_completion(api_key, messages):
+    """Ask OpenRouter for a reply using one key; raises on API errors"""
+    client = get_client_for_key(api_key)
+    raw = client.chat.completions.with_raw_response.create(
+        model="openai/gpt-3.5-turbo",
+        messages=messages,
+        max_tokens=50,
+        temperature=0.5
+    )
+    _report_key_quota(api_key, raw.headers)
+    return raw.parse().choices[0].message.content.strip()
+
+def _record_key_quota(api_key, headers):
+    """Weight the key by the quota its rate-limit headers say is left; returns a cooldown end if it ran out"""
+    quota = parse_rate_limit_headers(headers)
+    return key_pool.report_quota(api_key, *quota) if quota else None
+
+def _report_key_quota(api_key, headers):
+    failed_until = _record_key_quota(api_key, headers)
+    if failed_until:
+        log_debug(f"[Key Rotation] Key {key_pool.label(api_key)} has no quota left, resting until it resets")
+        _share_key_cooldown(api_key, failed_until)
+
+def _share_key_cooldown(api_key, failed_until):
+    """Let other workers rest the key too"""
+    if shared_state.shared:
+        shared_state.set('key_cooldown', _key_id(api_key), failed_until, failed_until - time.time())
+
+def _report_key_failure(api_key, err):
+    """Log an API error and put the key into cooldown"""
+    key_label = key_pool.label(api_key)
+    logger.debug(f"[Key Rotation] Key {key_label} error: {err}", exc_info=err)
+    # rate limited keys rejoin at the back once their cooldown ends
+    key_results.inc(key_label, key_error_kind(str(err)))
+    rate_limited = is_rate_limit_error(str(err))
+    retry_at = None
+    if rate_limited:
+        log_debug(f"[Key Rotation] Key {key_label} is rate-limited or quota-exhausted, cooling down")
+        # A 429 from OpenRouter says when the quota resets
+        quota = parse_rate_limit_headers(getattr(getattr(err, 'response', None), 'headers', None))
+        retry_at = quota[2] if quota else None
+    failed_until = key_pool.report_failure(api_key, rate_limited=rate_limited, retry_at=retry_at)
+    if failed_until:
+        _share_key_cooldown(api_key, failed_until)
+
+def _key_id(api_key):
+    """Stable name for a key in shared state, so the key itself is never stored there"""
+    return hashlib.sha1(api_key.encode('utf-8')).hexdigest()[:16]
+
+_last_key_sync = 0.0
+
+def _sync_key_cooldowns():
+    """Apply cooldowns other workers reported, at most once per KEY_STATE_SYNC_INTERVAL"""
+    global _last_key_sync
+    now = time.time()
+    if not shared_state.shared or now - _last_key_sync < KEY_STATE_SYNC_INTERVAL:
+        return
+    _last_key_sync = now
+    cooldowns = shared_state.items('key_cooldown')
+    if cooldowns:
+        for api_key in openrouter_keys:
+            failed_until = cooldowns.get(_key_id(api_key))
+            if failed_until:
+                key_pool.apply_cooldown(api_key, failed_until)
+
+def _report_key_success(api_key):
+    key_results.inc(key_pool.label(api_key), 'success')
+    key_pool.report_success(api_key)
+
+def _hedged_completion(messages, first_key, tried):
+    """Race requests across keys, starting another one every HEDGE_DELAY_SECONDS.
+
+    At most HEDGE_MAX_PARALLEL requests are in flight. A failed request is
+    replaced by one on the next healthy key straight away. Once a reply
+    arrives, requests that haven't started are cancelled and the rest are
+    abandoned: their results are discarded and their keys are not penalised.
+    """
+    in_flight = {}  # future -> api key
+
+    def launch(api_key=None):
+        if api_key is None:
+            api_key = key_pool.next_key(exclude=tried)
+            if api_key is None:
+                return False
+            tried.add(api_key)
+        log_debug(f"[Hedge] Sending request on key {key_pool.label(api_key)} ({len(in_flight) + 1} in flight)")
+        in_flight[_hedge_executor.submit(_request_completion, api_key, messages)] = api_key
+        return True
+
+    launch(first_key)
+    keys_left = True
+    try:
+        while in_flight:
+            can_hedge = keys_left and len(in_flight) < HEDGE_MAX_PARALLEL
+            done, _ = wait(list(in_flight), timeout=HEDGE_DELAY_SECONDS if can_hedge else None,
+                           return_when=FIRST_COMPLETED)
+            if not done:
+                keys_left = launch()
+                continue
+            for future in done:
+                api_key = in_flight.pop(future)
+                try:
+                    reply = future.result()
+                except Exception as err:
+                    _report_key_failure(api_key, err)
+                    reply = None
+                if reply:
+                    log_debug(f"[Hedge] Key {key_pool.label(api_key)} answered first: {reply[:100]}...")
+                    _report_key_success(api_key)
+                    return reply
+                if keys_left:
+                    keys_left = launch()
+        return None
+    finally:
+        for future in in_flight:
+            future.cancel()
+
+def _build_messages(message, voice, conversation):
+    """Return (messages for the API, cleaned conversation including the new message, validated voice)"""
     # Validate voice
     if voice not in PERSONALITIES:
         voice = 'Anna'
 
-    # Get the personality for the selected voice
-    personality = PERSONALITIES[voice]
-
     # Clean conversation: remove any messages with empty or None content
     clean_conversation = [msg for msg in conversation if msg.get('content', '').strip()]
     
+    # Personality prompt, then as much recent history as the token budget allows
+    messages, tokens = context_window.build(voice, clean_conversation, message)
+    prompt_tokens.observe(tokens, voice)
+
     # Add user message
     clean_conversation = clean_conversation + [{"role": "user", "content": message}]
+    return messages, clean_conversation, voice
+
+def _fallback_reply(message, voice, clean_conversation):
+    fallback_context = {
+        "conversation_length": len(clean_conversation),
+        "is_greeting": any(word in message.lower() for word in ['hi', 'hello', 'hey']),
+    }
+    fallback_replies.inc()
+    fallback_reply = get_fallback_response(message, voice, fallback_context)
+    return fallback_reply["reply"]
 
-    # Create messages with personality and full conversation context (limit to last 10)
-    messages = [{"role": "system", "content": personality}] + clean_conversation[-10:]
+def _cached_reply(message, voice, clean_conversation):
+    """Reply another user already got for this message in the same context, if any"""
+    if response_cache is None:
+        return None
+    reply = response_cache.get(message, voice, clean_conversation[:-1])
+    if reply:
+        log_debug(f"[Response Cache] Hit for message: {message}")
+    return reply
+
+def _remember_reply(message, voice, clean_conversation, reply):
+    if response_cache is not None and reply:
+        response_cache.put(message, voice, clean_conversation[:-1], reply)
+
+def answer_locally(message):
+    """Return (reply, intent) if the message can be answered without the API or memory, else None.
+
+    Covers canned replies (greetings included), a bare exit phrase like
+    "bye" and small talk the intent classifier is confident about; longer
+    messages that merely contain an exit phrase still go to the model.
+    """
+    reply = match_custom_response(message)
+    if reply:
+        local_replies.inc('custom')
+        return reply, 'custom'
+    if _normalize(message) in EXIT_PHRASES:
+        local_replies.inc('exit')
+        return "Goodbye! See you soon.", 'exit'
+    if intent_router is not None:
+        routed = intent_router.route(message)
+        if routed:
+            intent, confidence = routed
+            log_debug(f"[Intent] Answering locally: '{message}' -> {intent} ({confidence:.2f})")
+            local_replies.inc(intent)
+            return get_intent_reply(intent), intent
+    return None
 
-    log_debug(f"[get_chat_response] Starting with {len(openrouter_keys)} keys")
+def get_chat_response(message, voice='friendly', conversation=[]):
+    # Callers have already tried answer_locally(), which needs neither a key nor the conversation
+    messages, clean_conversation, voice = _build_messages(message, voice, conversation)
+
+    with span('response_cache'):
+        reply = _cached_reply(message, voice, clean_conversation)
+    if reply:
+        return reply
+
+    _sync_key_cooldowns()
+    log_debug(f"[get_chat_response] Starting with {len(key_pool)} keys ({key_pool.available_count()} available)")
     log_debug(f"[get_chat_response] Message: {message}")
 
     reply = None
-    for attempt in range(len(openrouter_keys)):
-        current_key = openrouter_keys[attempt]
-        
-        # skip keys that failed recently
-        failed_until = failed_keys.get(current_key, 0)
-        if failed_until > time.time():
-            log_debug(f"[Key Rotation] Skipping key at position {attempt} (in cooldown until {failed_until})")
-            continue
+    tried = set()
+    while True:
+        # Best healthy key we haven't tried yet; keys in cooldown are skipped
+        with span('key_select'):
+            current_key = key_pool.next_key(exclude=tried)
+        if current_key is None:
+            break
+        tried.add(current_key)
+        key_label = key_pool.label(current_key)
 
         try:
-            # Check for custom responses first
-            user_msg_normalized = _normalize(message)
-            if user_msg_normalized in NORMALIZED_CUSTOM_RESPONSES:
-                reply = NORMALIZED_CUSTOM_RESPONSES[user_msg_normalized]
-                log_debug(f"[Custom Response] Using custom response for message: {message}")
-                return reply
+            if HEDGE_DELAY_SECONDS > 0:
+                # Hedged mode tries every remaining key itself
+                started = time.perf_counter()
+                with span('upstream', key=key_label, hedged=True):
+                    reply = _hedged_completion(messages, current_key, tried)
+                if reply:
+                    upstream_latency.observe(time.perf_counter() - started, voice)
+                    _remember_reply(message, voice, clean_conversation, reply)
+                    return reply
+                break
 
             # Try API with current key
-            log_debug(f"[Key Rotation] Trying key at position {attempt} out of {len(openrouter_keys)}")
-            client = get_client(attempt)
-
-            response = client.chat.completions.create(
-                model="openai/gpt-3.5-turbo",
-                messages=messages,
-                max_tokens=50,
-                temperature=0.5
-            )
-
-            reply = response.choices[0].message.content.strip()
+            log_debug(f"[Key Rotation] Trying key {key_label} (attempt {len(tried)} of {len(key_pool)})")
+            started = time.perf_counter()
+            with span('upstream', key=key_label) as attempt:
+                attempt['ok'] = False
+                reply = _request_completion(current_key, messages)
+                attempt['ok'] = True
+            upstream_latency.observe(time.perf_counter() - started, voice)
             log_debug(f"[API Response] Got reply: {reply[:100]}...")
 
-            # Success! Rotate this working key to front
+            # Success! Keep using this key first
             if reply:
-                log_debug(f"[Key Rotation] Success with key at position {attempt}, rotating to front")
-                rotate_keys_to_front(attempt)
+                log_debug(f"[Key Rotation] Success with key {key_label}")
+                _report_key_success(current_key)
+                _remember_reply(message, voice, clean_conversation, reply)
                 return reply
 
         except Exception as err:
-            error_str = str(err)
-            log_debug(f"[Key Rotation] Key at position {attempt} error: {err}")
-            log_debug(f"[Key Rotation] Full error traceback:")
-            traceback.print_exc()
-            # mark this actual key as failed briefly
-            failed_keys[current_key] = time.time() + KEY_COOLDOWN_SECONDS
-            if "rate limit" in error_str.lower() or "quota" in error_str.lower() or "429" in error_str or "you exceeded your current quota" in error_str.lower() or "402" in error_str or "insufficient" in error_str.lower():
-                # deprioritize rate limited keys by moving to end
-                log_debug(f"[Key Rotation] Key at position {attempt} is rate-limited or quota-exhausted, moving to end")
-                rotate_key_to_end(attempt)
+            _report_key_failure(current_key, err)
             time.sleep(0.1)
             continue
     
     # Fallback response if all keys fail or no keys available
-    log_debug(f"[Fallback] All API attempts exhausted (tried {len(openrouter_keys)} keys), using intelligent fallback")
-    fallback_context = {
-        "conversation_length": len(clean_conversation),
-        "is_greeting": any(word in message.lower() for word in ['hi', 'hello', 'hey']),
+    log_debug(f"[Fallback] All API attempts exhausted (tried {len(tried)} of {len(key_pool)} keys), using intelligent fallback")
+    with span('fallback', keys_tried=len(tried)):
+        return _fallback_reply(message, voice, clean_conversation)
+
+def _request_completion_stream(api_key, messages):
+    """Ask OpenRouter for a streamed reply using one key; yields text deltas"""
+    client = get_client_for_key(api_key)
+    raw = client.chat.completions.with_raw_response.create(
+        model="openai/gpt-3.5-turbo",
+        messages=messages,
+        max_tokens=50,
+        temperature=0.5,
+        stream=True
+    )
+    _report_key_quota(api_key, raw.headers)
+    for chunk in raw.parse():
+        if chunk.choices and chunk.choices[0].delta.content:
+            yield chunk.choices[0].delta.content
+
+def stream_chat_response(message, voice='friendly', conversation=[]):
+    """Like get_chat_response, but yields the reply in pieces as they arrive.
+
+    Cached and fallback replies are yielded in one piece. A key that fails
+    before sending anything is skipped like in get_chat_response; once part of
+    a reply has been sent, a failure ends the stream with what we have.
+    Callers answer what answer_locally() can before calling this.
+    """
+    messages, clean_conversation, voice = _build_messages(message, voice, conversation)
+
+    reply = _cached_reply(message, voice, clean_conversation)
+    if reply:
+        yield reply
+        return
+
+    _sync_key_cooldowns()
+    log_debug(f"[stream_chat_response] Starting with {len(key_pool)} keys ({key_pool.available_count()} available)")
+    log_debug(f"[stream_chat_response] Message: {message}")
+
+    tried = set()
+    while True:
+        current_key = key_pool.next_key(exclude=tried)
+        if current_key is None:
+            break
+        tried.add(current_key)
+        key_label = key_pool.label(current_key)
+
+        started = False
+        parts = []
+        try:
+            log_debug(f"[Key Rotation] Streaming with key {key_label} (attempt {len(tried)} of {len(key_pool)})")
+            for delta in _request_completion_stream(current_key, messages):
+                if not started:
+                    delta = delta.lstrip()
+                    if not delta:
+                        continue
+                    started = True
+                parts.append(delta)
+                yield delta
+            if started:
+                log_debug(f"[Key Rotation] Success with key {key_label}")
+                _report_key_success(current_key)
+                _remember_reply(message, voice, clean_conversation, ''.join(parts).strip())
+                return
+        except Exception as err:
+            _report_key_failure(current_key, err)
+            if started:
+                return
+            time.sleep(0.1)
+            continue
+
+    log_debug(f"[Fallback] All API attempts exhausted (tried {len(tried)} of {len(key_pool)} keys), using intelligent fallback")
+    yield _fallback_reply(message, voice, clean_conversation)
+
+def _find_duplicate(user_id, normalized_message, current_time):
+    """Return the cached reply if this user just sent the same message, else None"""
+    cached = message_cache.get(user_id)
+    if (not cached or cached['text'] != normalized_message) and shared_state.shared:
+        # The first attempt may have been answered by another worker
+        cached = shared_state.get('dup', user_id)
+    if cached:
+        time_since_last = current_time - cached['time']
+        
+        # Check for exact duplicate within window
+        if cached['text'] == normalized_message and time_since_last < DUPLICATE_WINDOW_SECONDS:
+            duplicate_hits.inc()
+            logger.info(f"[DUPLICATE BLOCKED] User {user_id}: '{normalized_message[:30]}' (EXACT, {time_since_last:.2f}s ago)")
+            return cached
+    return None
+
+def _answer_and_save(timer, user_id, user_message, normalized_message, voice, current_time):
+    """Load memory, get the model reply and save the exchange; returns the reply"""
+    logger.info(f"[NEW MESSAGE] User {user_id}: '{user_message[:50]}...' at {current_time}")
+
+    # Only this user's history is read; empty messages are already dropped
+    with timer.stage('memory_load'):
+        user_conversation = memory_store.get_conversation(user_id)
+
+    with timer.stage('model'):
+        reply = get_chat_response(user_message, voice, user_conversation)
+
+    # Ensure reply is valid
+    if not reply or not reply.strip():
+        logger.error("[ERROR] Empty reply from get_chat_response")
+        reply = "I'm having some connectivity issues right now, but I'm still here to chat!"
+
+    with timer.stage('memory_save'):
+        _save_exchange(user_id, user_message, normalized_message, reply, current_time, user_conversation)
+    return reply
+
+def _save_exchange(user_id, user_message, normalized_message, reply, current_time, user_conversation):
+    """Store the new turns in conversation memory and the duplicate cache"""
+    # Save to conversation memory
+    logger.info(f"[MESSAGE SAVE] Saving for user {user_id}")
+    new_turns = [
+        {"role": "user", "content": user_message},
+        {"role": "assistant", "content": reply}
+    ]
+    memory_store.append_turns(user_id, new_turns)
+    user_conversation = (user_conversation + new_turns)[-memory_store.max_entries:]
+    logger.info(f"[MESSAGE SAVE] Complete - conversation now has {len(user_conversation)} entries")
+    _cache_message(user_id, normalized_message, reply, current_time)
+    return user_conversation
+
+def _cache_message(user_id, normalized_message, reply, current_time):
+    """Remember the last message and reply per user for duplicate detection"""
+    entry = {
+        'text': normalized_message,
+        'time': current_time,
+        'response': reply
     }
-    fallback_reply = get_fallback_response(message, voice, fallback_context)
-    return fallback_reply["reply"]
+    # Expired entries and, past MESSAGE_CACHE_USERS, the oldest one are dropped here
+    message_cache.put(user_id, entry)
+    if shared_state.shared:
+        shared_state.set('dup', user_id, entry, DUPLICATE_WINDOW_SECONDS)
+
+def _voice_session_after_reply(user_id, user_message, is_exit_phrase):
+    """End the session on an exit phrase, otherwise keep listening; returns the status for the frontend"""
+    if is_exit_phrase:
+        logger.info(f"[EXIT PHRASE] Detected from user {user_id}")
+        end_voice_session(user_id, 'exit_phrase')
+        return {
+            "active": False,
+            "should_listen": False,
+            "exit_triggered": True,
+            "exit_message": "Goodbye! See you soon."
+        }
+    start_voice_session(user_id)
+    update_voice_session(user_id, user_message)
+    status = get_voice_session_status(user_id)
+    if voice_events.has_subscribers(user_id):
+        voice_events.publish(user_id, 'listening_window', status)
+        _schedule_silence_check(user_id)
+    return status
+
+def parse_batch_items(data):
+    """Validate a batch body (a list, or {"items": [...]}); returns (items, error message)"""
+    items = data.get('items') if isinstance(data, dict) else data
+    if not isinstance(items, list) or not items:
+        return None, "Expected a non-empty list of {message, user_id, voice} items"
+    if len(items) > CHAT_BATCH_MAX_ITEMS:
+        return None, f"At most {CHAT_BATCH_MAX_ITEMS} items per batch"
+    parsed = []
+    for item in items:
+        item = item if isinstance(item, dict) else {}
+        message = item.get('message')
+        voice = item.get('voice', 'Anna')
+        parsed.append({
+            "message": message.strip() if isinstance(message, str) else '',
+            "user_id": str(item.get('user_id', 'default_user')),
+            "voice": voice if voice in ALLOWED_VOICES else 'Anna'
+        })
+    return parsed, None
+
+def group_batch_items(items):
+    """Item indexes per user, in the order they were sent"""
+    chains = {}
+    for index, item in enumerate(items):
+        chains.setdefault(item['user_id'], []).append(index)
+    return list(chains.values())
+
+def _batch_quick_result(item, current_time, previous):
+    """Result for an item that needs no model call (empty, repeated or answered locally), else None.
+
+    `previous` is the (normalized message, reply) of this user's previous item
+    in the batch, which isn't in the duplicate cache yet.
+    """
+    user_id = item['user_id']
+    if not item['message']:
+        return {"status": "error", "error": "Please provide a message to chat with me!", "user_id": user_id}
+    normalized_message = item['message'].lower().strip()
+    cached = _find_duplicate(user_id, normalized_message, current_time)
+    if cached or (previous and previous[0] == normalized_message):
+        reply = cached['response'] if cached else previous[1]
+        return {"status": "ok", "reply": reply, "source": "cache", "duplicate": True, "user_id": user_id}
+    local = answer_locally(item['message'])
+    if local:
+        reply, intent = local
+        _cache_message(user_id, normalized_message, reply, current_time)
+        return {"status": "ok", "reply": reply, "source": "local", "intent": intent,
+                "message_saved": False, "user_id": user_id}
+    return None
+
+def _batch_api_result(item, reply):
+    if not reply or not reply.strip():
+        reply = "I'm having some connectivity issues right now, but I'm still here to chat!"
+    return {"status": "ok", "reply": reply, "source": "api", "selected_voice": item['voice'],
+            "message_saved": False, "user_id": item['user_id']}
+
+def _batch_error_result(item, error):
+    logger.exception(f"[Batch] Error answering for user {item['user_id']}: {error}")
+    return {"status": "error", "error": str(error), "user_id": item['user_id']}
+
+def _answer_batch_chain(items, indexes, current_time):
+    """Answer one user's items in order; returns ({index: result}, new turns, indexes to save)"""
+    results, turns, to_save = {}, [], []
+    conversation = None
+    previous = None
+    for index in indexes:
+        item = items[index]
+        try:
+            result = _batch_quick_result(item, current_time, previous)
+            if result is None:
+                if conversation is None:
+                    conversation = memory_store.get_conversation(item['user_id'])
+                result = _batch_api_result(item, get_chat_response(item['message'], item['voice'], conversation))
+                new_turns = [
+                    {"role": "user", "content": item['message']},
+                    {"role": "assistant", "content": result['reply']}
+                ]
+                conversation = (conversation + new_turns)[-memory_store.max_entries:]
+                turns.extend(new_turns)
+                to_save.append(index)
+        except Exception as e:
+            result = _batch_error_result(item, e)
+        results[index] = result
+        if result['status'] == 'ok':
+            previous = (item['message'].lower().strip(), result['reply'])
+    return results, turns, to_save
+
+def _save_batch(items, results, writes, to_save, current_time):
+    """Write every user's new turns in one memory store transaction, then mark them saved"""
+    if not writes:
+        return
+    try:
+        memory_store.append_many(writes)
+    except Exception as e:
+        logger.exception(f"[Batch] Error saving {len(to_save)} exchanges: {e}")
+        return
+    for index in to_save:
+        item = items[index]
+        results[index]['message_saved'] = True
+        _cache_message(item['user_id'], item['message'].lower().strip(), results[index]['reply'], current_time)
 
 @app.route('/chat', methods=['POST', 'OPTIONS'])
 @app.route('/api/chat', methods=['POST', 'OPTIONS'])
@@ -394,9 +1050,9 @@ def chat():
         return response, 204
     
     try:
-        print(f"[DEBUG] Received request method: {request.method}")
-        print(f"[DEBUG] Content-Type: {request.headers.get('Content-Type')}")
-        print(f"[DEBUG] Is Mobile: {request.headers.get('X-Requested-With', 'Unknown')}")
+        logger.debug(f"[DEBUG] Received request method: {request.method}")
+        logger.debug(f"[DEBUG] Content-Type: {request.headers.get('Content-Type')}")
+        logger.debug(f"[DEBUG] Is Mobile: {request.headers.get('X-Requested-With', 'Unknown')}")
 
         # Try to get JSON data
         try:
@@ -404,7 +1060,7 @@ def chat():
             if not data:
                 data = {}
         except Exception as json_error:
-            print(f"[DEBUG] JSON parsing failed: {json_error}")
+            logger.debug(f"[DEBUG] JSON parsing failed: {json_error}")
             resp = jsonify({"reply": "Error: Invalid JSON data", "success": False})
             resp.headers['Access-Control-Allow-Origin'] = '*'
             return resp, 400
@@ -416,19 +1072,11 @@ def chat():
         is_mobile = data.get('is_mobile', False)
         is_voice_input = data.get('is_voice_input', False)
         
-        allowed_voices = ['Anna', 'Irish', 'Alexa', 'Jak', 'Alecx']
-        backend_voice_map = {
-            'Anna': 'Microsoft Zira',  # Professional English female
-            'Irish': 'Microsoft Siobhan',
-            'Alexa': 'Amazon Alexa',
-            'Jak': 'Microsoft Jak',
-            'Alecx': 'Microsoft Alecx'
-        }
-        if voice not in allowed_voices:
+        if voice not in ALLOWED_VOICES:
             voice = 'Anna'
-        system_voice_name = backend_voice_map.get(voice, 'Microsoft Anna')
+        system_voice_name = BACKEND_VOICE_MAP.get(voice, 'Microsoft Anna')
 
-        print(f"[DEBUG] Mobile: {is_mobile}, Voice Input: {is_voice_input}, Message: '{user_message[:50]}...', User: '{user_id}'")
+        logger.debug(f"[DEBUG] Mobile: {is_mobile}, Voice Input: {is_voice_input}, Message: '{user_message[:50]}...', User: '{user_id}'")
 
         if not user_message:
             resp = jsonify({
@@ -439,93 +1087,71 @@ def chat():
             resp.headers['Access-Control-Allow-Origin'] = '*'
             return resp, 400
 
+        timer = g.timer = StageTimer(new_request_id(request.headers.get('X-Request-ID')))
+        timer.activate()
         current_time = time.time()
         normalized_message = user_message.lower().strip()
         
         # MOBILE FIX: Stricter duplicate detection with timestamp validation
-        if user_id in message_cache:
-            cached = message_cache[user_id]
-            time_since_last = current_time - cached['time']
-            
-            # Check for exact duplicate within window
-            if cached['text'] == normalized_message and time_since_last < DUPLICATE_WINDOW_SECONDS:
-                print(f"[DUPLICATE BLOCKED] User {user_id}: '{user_message[:30]}' (EXACT, {time_since_last:.2f}s ago)")
-                resp = jsonify({
-                    "reply": cached['response'], 
-                    "source": "cache", 
-                    "duplicate": True,
-                    "success": True,
-                    "user_id": user_id
-                })
-                resp.headers['Access-Control-Allow-Origin'] = '*'
-                return resp
-
-        print(f"[NEW MESSAGE] User {user_id}: '{user_message[:50]}...' at {current_time}")
+        cached = _find_duplicate(user_id, normalized_message, current_time)
+        if cached:
+            resp = jsonify({
+                "reply": cached['response'], 
+                "source": "cache", 
+                "duplicate": True,
+                "success": True,
+                "user_id": user_id
+            })
+            resp.headers['Access-Control-Allow-Origin'] = '*'
+            return resp
 
-        memory = load_memory()
-        user_conversation = memory.get(user_id, [])
-        
-        # Clean conversation history: remove any messages with empty or None content
-        user_conversation = [msg for msg in user_conversation if msg.get('content', '').strip()]
-        
         is_exit_phrase = detect_exit_phrase(user_message)
-        reply = get_chat_response(user_message, voice, user_conversation)
-        
-        # Ensure reply is valid
-        if not reply or not reply.strip():
-            print(f"[ERROR] Empty reply from get_chat_response")
-            reply = "I'm having some connectivity issues right now, but I'm still here to chat!"
-        
-        # Save to conversation memory
-        print(f"[MESSAGE SAVE] Saving for user {user_id}")
-        user_conversation.append({"role": "user", "content": user_message})
-        user_conversation.append({"role": "assistant", "content": reply})
-        user_conversation = user_conversation[-20:]
-        memory[user_id] = user_conversation
-        save_memory(memory)
-        print(f"[MESSAGE SAVE] Complete - conversation now has {len(user_conversation)} entries")
-        
-        # Update cache with this message
-        message_cache[user_id] = {
-            'text': normalized_message,
-            'time': current_time,
-            'response': reply
-        }
-        
-        # Cleanup old cache entries
-        if len(message_cache) > 1000:
-            oldest_user = min(message_cache.keys(), key=lambda k: message_cache[k]['time'])
-            del message_cache[oldest_user]
 
-        response_data = {
+        # Fast path: canned replies, greetings and a bare "bye" are answered
+        # here without touching conversation memory
+        with timer.stage('fast_path'):
+            local = answer_locally(user_message)
+
+        if local:
+            reply, intent = local
+            logger.info(f"[LOCAL REPLY] User {user_id}: '{user_message[:50]}...' ({intent})")
+            _cache_message(user_id, normalized_message, reply, current_time)
+            response_data = {"source": "local", "intent": intent, "message_saved": False}
+        else:
+            # The same message may still be on its way upstream for a resend
+            # that arrived a moment earlier; if so, share that reply
+            reply, coalesced = pending_replies.do((user_id, normalized_message), _answer_and_save,
+                                            timer, user_id, user_message, normalized_message, voice, current_time)
+            if coalesced:
+                coalesced_requests.inc()
+                logger.info(f"[DUPLICATE COALESCED] User {user_id}: '{normalized_message[:30]}' (in flight)")
+                response_data = {"source": "coalesced", "duplicate": True, "message_saved": False}
+            else:
+                response_data = {"message_saved": True}
+
+        response_data.update({
             "reply": reply, 
             "voice_response_finished": True, 
             "selected_voice": voice, 
             "backend_voice": system_voice_name,
-            "message_saved": True,
             "timestamp": current_time,
             "user_id": user_id,
             "success": True,
             "is_mobile": is_mobile
-        }
-        
-        if is_exit_phrase:
-            print(f"[EXIT PHRASE] Detected from user {user_id}")
-            end_voice_session(user_id)
-            response_data["voice_session"] = {
-                "active": False,
-                "should_listen": False,
-                "exit_triggered": True,
-                "exit_message": "Goodbye! See you soon."
-            }
-        else:
-            start_voice_session(user_id)
-            update_voice_session(user_id, user_message)
-            session_status = get_voice_session_status(user_id)
-            response_data["voice_session"] = session_status
+        })
+        response_data["voice_session"] = _voice_session_after_reply(user_id, user_message, is_exit_phrase)
+        response_data["timings"] = timer.as_dict()
+        response_data["request_id"] = timer.request_id
+        record_chat_metrics(voice, response_data.get("source", "api"), timer)
         
-        print(f"[DEBUG] Returning success reply: {reply[:100]}")
-        resp = jsonify(response_data)
+        logger.debug(f"[DEBUG] Returning success reply: {reply[:100]}")
+        with timer.stage('serialize'):
+            resp = jsonify(response_data)
+        resp.headers['Server-Timing'] = timer.server_timing()
+        resp.headers['X-Request-ID'] = timer.request_id
+        if request.headers.get('X-Timing'):
+            # Full span list on request, for digging into one slow reply
+            resp.headers['X-Timing'] = json.dumps(timer.span_list(), separators=(',', ':'))
         resp.headers['Access-Control-Allow-Origin'] = '*'
         resp.headers['Access-Control-Allow-Methods'] = 'GET, POST, OPTIONS'
         resp.headers['Access-Control-Allow-Headers'] = 'Content-Type, Authorization, X-Requested-With'
@@ -536,8 +1162,7 @@ def chat():
         return resp
 
     except Exception as e:
-        print(f"Uncaught error in chat: {e}")
-        traceback.print_exc()
+        logger.exception(f"Uncaught error in chat: {e}")
         resp = jsonify({
             "reply": "Oops, something went wrong on my end. Let's give it another shot!",
             "error": str(e),
@@ -550,6 +1175,187 @@ def chat():
         return resp, 200
 
 
+@app.teardown_request
+def _finish_trace(exc):
+    """Close the request's timer; slow or sampled requests go to the trace log"""
+    timer = g.pop('timer', None)
+    if timer is not None:
+        timer.finish(path=request.path, status='error' if exc else 'ok')
+
+def _sse_event(event, payload):
+    return f"event: {event}\ndata: {json.dumps(payload, ensure_ascii=False)}\n\n"
+
+@app.route('/chat/stream', methods=['POST', 'OPTIONS'])
+@app.route('/api/chat/stream', methods=['POST', 'OPTIONS'])
+def chat_stream():
+    """Streaming variant of /api/chat using Server-Sent Events.
+
+    Sends "delta" events ({"text": ...}) as the reply is generated, then one
+    "done" event with the same fields /api/chat returns, or an "error" event.
+    """
+    if request.method == 'OPTIONS':
+        response = jsonify({})
+        response.headers.add('Access-Control-Allow-Origin', '*')
+        response.headers.add('Access-Control-Allow-Methods', 'POST, OPTIONS')
+        response.headers.add('Access-Control-Allow-Headers', 'Content-Type, Authorization, X-Requested-With')
+        return response, 204
+
+    data = request.get_json(silent=True) or {}
+    user_message = (data.get('message', '') or '').strip()
+    user_id = data.get('user_id', 'default_user')
+    voice = data.get('voice', 'Anna')
+    is_mobile = data.get('is_mobile', False)
+    if voice not in ALLOWED_VOICES:
+        voice = 'Anna'
+    system_voice_name = BACKEND_VOICE_MAP.get(voice, 'Microsoft Anna')
+
+    if not user_message:
+        resp = jsonify({
+            "reply": "Please provide a message to chat with me!",
+            "success": False,
+            "user_id": user_id
+        })
+        resp.headers['Access-Control-Allow-Origin'] = '*'
+        return resp, 400
+
+    def generate():
+        try:
+            current_time = time.time()
+            normalized_message = user_message.lower().strip()
+
+            cached = _find_duplicate(user_id, normalized_message, current_time)
+            if cached:
+                yield _sse_event("delta", {"text": cached['response']})
+                yield _sse_event("done", {
+                    "reply": cached['response'],
+                    "source": "cache",
+                    "duplicate": True,
+                    "success": True,
+                    "user_id": user_id
+                })
+                return
+
+            is_exit_phrase = detect_exit_phrase(user_message)
+
+            local = answer_locally(user_message)
+            if local:
+                reply, intent = local
+                _cache_message(user_id, normalized_message, reply, current_time)
+                yield _sse_event("delta", {"text": reply})
+                yield _sse_event("done", {
+                    "reply": reply,
+                    "source": "local",
+                    "intent": intent,
+                    "voice_response_finished": True,
+                    "selected_voice": voice,
+                    "backend_voice": system_voice_name,
+                    "message_saved": False,
+                    "timestamp": current_time,
+                    "user_id": user_id,
+                    "success": True,
+                    "is_mobile": is_mobile,
+                    "voice_session": _voice_session_after_reply(user_id, user_message, is_exit_phrase)
+                })
+                return
+
+            logger.info(f"[NEW MESSAGE] User {user_id}: '{user_message[:50]}...' at {current_time} (stream)")
+            user_conversation = memory_store.get_conversation(user_id)
+
+            parts = []
+            for delta in stream_chat_response(user_message, voice, user_conversation):
+                parts.append(delta)
+                yield _sse_event("delta", {"text": delta})
+
+            reply = ''.join(parts).strip()
+            if not reply:
+                logger.error("[ERROR] Empty reply from stream_chat_response")
+                reply = "I'm having some connectivity issues right now, but I'm still here to chat!"
+                yield _sse_event("delta", {"text": reply})
+
+            _save_exchange(user_id, user_message, normalized_message, reply, current_time, user_conversation)
+
+            yield _sse_event("done", {
+                "reply": reply,
+                "voice_response_finished": True,
+                "selected_voice": voice,
+                "backend_voice": system_voice_name,
+                "message_saved": True,
+                "timestamp": current_time,
+                "user_id": user_id,
+                "success": True,
+                "is_mobile": is_mobile,
+                "voice_session": _voice_session_after_reply(user_id, user_message, is_exit_phrase)
+            })
+        except Exception as e:
+            logger.exception(f"Uncaught error in chat stream: {e}")
+            yield _sse_event("error", {
+                "reply": "Oops, something went wrong on my end. Let's give it another shot!",
+                "error": str(e),
+                "success": False
+            })
+
+    resp = Response(stream_with_context(generate()), mimetype='text/event-stream')
+    resp.headers['Access-Control-Allow-Origin'] = '*'
+    resp.headers['Cache-Control'] = 'no-cache'
+    resp.headers['X-Accel-Buffering'] = 'no'  # don't let proxies buffer the stream
+    return resp
+
+
+@app.route('/api/chat/batch', methods=['POST', 'OPTIONS'])
+def chat_batch():
+    """Answer several {message, user_id, voice} items in one request.
+
+    Results come back in the order of the items, each with its own "status"
+    ("ok" or "error"). Conversation memory for the whole batch is written
+    in one transaction. Voice sessions are not touched.
+    """
+    if request.method == 'OPTIONS':
+        response = jsonify({})
+        response.headers.add('Access-Control-Allow-Origin', '*')
+        response.headers.add('Access-Control-Allow-Methods', 'POST, OPTIONS')
+        response.headers.add('Access-Control-Allow-Headers', 'Content-Type, Authorization, X-Requested-With')
+        return response, 204
+
+    items, error = parse_batch_items(request.get_json(silent=True))
+    if error:
+        resp = jsonify({"error": error, "success": False})
+        resp.headers['Access-Control-Allow-Origin'] = '*'
+        return resp, 400
+
+    timer = g.timer = StageTimer(new_request_id(request.headers.get('X-Request-ID')))
+    timer.activate()
+    current_time = time.time()
+    results = [None] * len(items)
+    writes, to_save = {}, []
+    with timer.stage('answer', items=len(items)):
+        chains = group_batch_items(items)
+        futures = [_batch_executor.submit(_answer_batch_chain, items, chain, current_time) for chain in chains]
+        for chain, future in zip(chains, futures):
+            chain_results, turns, chain_to_save = future.result()
+            for index, result in chain_results.items():
+                results[index] = result
+            if turns:
+                writes[items[chain[0]]['user_id']] = turns
+            to_save.extend(chain_to_save)
+    with timer.stage('memory_save', users=len(writes)):
+        _save_batch(items, results, writes, to_save, current_time)
+    for result in results:
+        batch_items.inc(result['status'])
+
+    resp = jsonify({
+        "results": results,
+        "success": True,
+        "timestamp": current_time,
+        "timings": timer.as_dict(),
+        "request_id": timer.request_id
+    })
+    resp.headers['Server-Timing'] = timer.server_timing()
+    resp.headers['X-Request-ID'] = timer.request_id
+    resp.headers['Access-Control-Allow-Origin'] = '*'
+    resp.headers['Cache-Control'] = 'no-cache, no-store, must-revalidate'
+    return resp
+
+
 @app.route('/api/voice/status', methods=['POST', 'OPTIONS'])
 def voice_status():
     """Get current voice session status for user"""
@@ -564,52 +1370,13 @@ def voice_status():
         data = request.get_json()
         user_id = data.get('user_id', 'default_user')
         
-        session = voice_sessions.get(user_id, {})
-        current_time = time.time()
-        
-        # Check if we sent a silence prompt and user hasn't responded in 5 seconds
-        if session.get('prompt_sent_at'):
-            time_since_prompt = current_time - session['prompt_sent_at']
-            if time_since_prompt > 5 and is_session_silent(user_id):
-                log_debug(f"[Voice] No response to silence prompt for {time_since_prompt:.1f}s, ending session")
-                end_voice_session(user_id)
-                resp = jsonify({
-                    "active": False,
-                    "should_listen": False,
-                    "exit_triggered": True,
-                    "exit_message": "Goodbye! See you soon."
-                })
-                resp.headers['Access-Control-Allow-Origin'] = '*'
-                return resp
-        
-        # Check for silence and send prompt if needed
-        if is_session_silent(user_id):
-            session = voice_sessions.get(user_id, {})
-            if not session.get('prompt_sent_at'):
-                # First time detecting silence - send prompt
-                session['prompt_sent_at'] = current_time
-                log_debug(f"[Voice] Silence detected for user {user_id}, sending prompt")
-            
-            status = get_voice_session_status(user_id)
-            status["silence_prompt"] = "Is there anything I can do?"
-            resp = jsonify(status)
-            resp.headers['Access-Control-Allow-Origin'] = '*'
-            return resp
-        
-        # Reset prompt if user starts talking again
-        if session.get('prompt_sent_at'):
-            session['prompt_sent_at'] = None
-            log_debug(f"[Voice] User started talking again, resetting silence prompt")
-        
-        # Get current status
-        status = get_voice_session_status(user_id)
+        status = poll_voice_session(user_id)
         resp = jsonify(status)
         resp.headers['Access-Control-Allow-Origin'] = '*'
         return resp
     
     except Exception as e:
-        log_debug(f"[Voice Status] Error: {e}")
-        traceback.print_exc()
+        logger.exception(f"[Voice Status] Error: {e}")
         resp = jsonify({"error": str(e)})
         resp.headers['Access-Control-Allow-Origin'] = '*'
         return resp, 500
@@ -635,13 +1402,22 @@ def voice_end():
         return resp
     
     except Exception as e:
-        log_debug(f"[Voice End] Error: {e}")
-        traceback.print_exc()
+        logger.exception(f"[Voice End] Error: {e}")
         resp = jsonify({"error": str(e)})
         resp.headers['Access-Control-Allow-Origin'] = '*'
         return resp, 500
 
 
+@app.route('/api/metrics', methods=['GET'])
+def metrics_endpoint():
+    """Prometheus text exposition of the counters and histograms above"""
+    resp = Response(metrics.render(), mimetype='text/plain')
+    resp.headers['Content-Type'] = Registry.CONTENT_TYPE
+    resp.headers['Access-Control-Allow-Origin'] = '*'
+    resp.headers['Cache-Control'] = 'no-cache'
+    return resp
+
+
 @app.route('/health', methods=['GET', 'OPTIONS'])
 @app.route('/api/health', methods=['GET', 'OPTIONS'])
 def health():
@@ -654,14 +1430,14 @@ def health():
     
     try:
         keys_count = len(openrouter_keys)
-        resp = jsonify({"ok": True, "keys": keys_count, "openai_available": openai_available})
+        resp = jsonify({"ok": True, "keys": keys_count, "openai_available": openai_available,
+                        "voice_events": False})
         resp.headers['Access-Control-Allow-Origin'] = '*'
         resp.headers['Access-Control-Allow-Methods'] = 'GET, OPTIONS'
         resp.headers['Access-Control-Allow-Headers'] = 'Content-Type'
         return resp
     except Exception as e:
-        print(f"Health check error: {e}")
-        traceback.print_exc()
+        logger.exception(f"Health check error: {e}")
         resp = jsonify({"ok": False, "error": str(e)})
         resp.headers['Access-Control-Allow-Origin'] = '*'
         return resp, 500
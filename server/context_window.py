@@ -0,0 +1,108 @@
+"""
+Prompt assembly within a token budget.
+The model used to get the personality prompt plus the last 10 turns whatever
+their length, so one long message made every later prompt expensive and
+short chats sent less context than they could afford. Here tokens are
+estimated locally, the newest turns that fit CONTEXT_TOKEN_BUDGET are kept,
+and older ones are folded into a one-line summary of what the user said.
+"""
+
+import os
+import re
+from functools import lru_cache
+
+CONTEXT_TOKEN_BUDGET = int(os.getenv('CONTEXT_TOKEN_BUDGET', '1000'))  # prompt tokens per request
+CONTEXT_MAX_TURNS = int(os.getenv('CONTEXT_MAX_TURNS', '20'))  # never more turns than this
+CONTEXT_SUMMARY_TOKENS = int(os.getenv('CONTEXT_SUMMARY_TOKENS', '120'))  # 0 drops old turns without a summary
+
+MESSAGE_OVERHEAD = 4  # role and separators around each chat message
+REPLY_PRIMING = 3  # tokens the API adds to start the reply
+SUMMARY_QUOTE_WORDS = 12  # each earlier user message is quoted up to this many words
+
+_PIECES = re.compile(r"\w+|[^\w\s]")
+
+
+@lru_cache(maxsize=4096)
+def estimate_tokens(text):
+    """Rough BPE count: ~4 characters per token for ASCII words, ~2 otherwise, 1 per symbol"""
+    tokens = 0
+    for piece in _PIECES.findall(text):
+        chars_per_token = 4 if piece.isascii() else 2
+        tokens += -(-len(piece) // chars_per_token)
+    return tokens
+
+
+def message_tokens(content):
+    return estimate_tokens(content) + MESSAGE_OVERHEAD
+
+
+def summarize_turns(turns, max_tokens):
+    """One system line quoting the user's earlier messages, newest kept first when space runs out"""
+    prefix = "Earlier in this conversation the user said: "
+    remaining = max_tokens - message_tokens(prefix)
+    quotes = []
+    for turn in reversed(turns):
+        if turn.get('role') != 'user':
+            continue
+        words = turn['content'].split()
+        quote = '"' + ' '.join(words[:SUMMARY_QUOTE_WORDS]) + ('..."' if len(words) > SUMMARY_QUOTE_WORDS else '"')
+        cost = estimate_tokens(quote) + 1
+        if cost > remaining:
+            break
+        quotes.append(quote)
+        remaining -= cost
+    if not quotes:
+        return None
+    return prefix + '; '.join(reversed(quotes))
+
+
+class ContextWindow:
+    """Builds the message list for a voice's personality prompt, history and new message"""
+
+    def __init__(self, prompts, budget=CONTEXT_TOKEN_BUDGET, max_turns=CONTEXT_MAX_TURNS,
+                 summary_tokens=CONTEXT_SUMMARY_TOKENS):
+        self.prompts = prompts
+        self.budget = budget
+        self.max_turns = max_turns
+        self.summary_tokens = summary_tokens
+        self._prompt_tokens = {}  # voice -> (prompt text, tokens)
+
+    def prompt_tokens(self, voice):
+        """Token count of a voice's system prompt, counted once per prompt text"""
+        prompt = self.prompts[voice]
+        cached = self._prompt_tokens.get(voice)
+        if cached is None or cached[0] != prompt:
+            cached = self._prompt_tokens[voice] = (prompt, message_tokens(prompt))
+        return cached[1]
+
+    def build(self, voice, history, message):
+        """Return (messages, estimated prompt tokens); the new message is always included"""
+        remaining = self.budget - self.prompt_tokens(voice) - message_tokens(message) - REPLY_PRIMING
+        costs = [message_tokens(turn['content']) for turn in history]
+
+        if len(history) <= self.max_turns and sum(costs) <= remaining:
+            kept = len(history)
+            summary = None
+        else:
+            # Not everything fits: keep room for the summary, then take the newest turns
+            if self.summary_tokens:
+                remaining -= self.summary_tokens
+            kept = 0
+            for cost in reversed(costs[-self.max_turns:]):
+                if cost > remaining:
+                    break
+                remaining -= cost
+                kept += 1
+            summary = summarize_turns(history[:len(history) - kept], self.summary_tokens) if self.summary_tokens else None
+
+        messages = [{"role": "system", "content": self.prompts[voice]}]
+        tokens = self.prompt_tokens(voice) + REPLY_PRIMING
+        if summary:
+            messages.append({"role": "system", "content": summary})
+            tokens += message_tokens(summary)
+        if kept:
+            messages.extend(history[-kept:])
+            tokens += sum(costs[-kept:])
+        messages.append({"role": "user", "content": message})
+        tokens += message_tokens(message)
+        return messages, tokens
@@ -1,12 +1,33 @@
 """
 Fallback response system for when external APIs fail.
 This ensures the bot always responds, even if OpenRouter API is unavailable.
+During an outage every request lands here at once, so the responder is built
+a single time and all intent phrases are matched in one regex pass.
 """
 
 import random
-import json
+import re
 from datetime import datetime
 
+GREETINGS = frozenset(['hi', 'hello', 'hey', 'yo', 'sup', 'what\'s up', 'hey there'])
+HOW_ARE_YOU_PHRASES = ['how are you', 'how you doing', 'how\'s it going', 'how you been']
+HELP_PHRASES = ['help', 'assist', 'support', 'what can you']
+THANKS_PHRASES = ['thank', 'thanks', 'appreciate', 'grateful']
+GOODBYE_PHRASES = ['bye', 'goodbye', 'see you', 'take care', 'exit', 'quit']
+THANKS_REPLY = "You're very welcome! Happy to help! 😊"
+GOODBYE_REPLY = "Goodbye! It was great chatting with you. Have an awesome day! 👋"
+
+STOP_WORDS = frozenset({'a', 'an', 'the', 'and', 'or', 'but', 'in', 'on', 'at', 'to', 'for', 'of', 'is', 'are', 'be', 'was', 'were', 'i', 'you', 'we', 'he', 'she', 'it', 'what', 'how', 'why', 'when', 'where', 'can', 'could', 'would', 'should', 'do', 'does', 'did', 'will', 'have', 'has', 'had'})
+
+# Text-to-speech voice for each selectable voice (app.py imports it from here)
+BACKEND_VOICE_MAP = {
+    'Anna': 'Microsoft Zira',  # Professional English female
+    'Irish': 'Microsoft Siobhan',
+    'Alexa': 'Amazon Alexa',
+    'Jak': 'Microsoft Jak',
+    'Alecx': 'Microsoft Alecx'
+}
+
 class FallbackResponder:
     """Provides intelligent fallback responses when API is unavailable"""
     
@@ -57,6 +78,41 @@ class FallbackResponder:
             "I'm not quite sure about that, but I'm happy to help with other questions!",
             "That's outside my current knowledge base, but feel free to ask something else!",
         ]
+
+        self._compile_intents()
+
+    def _compile_intents(self):
+        """Index every intent phrase in one pattern.
+
+        Intents are checked in a fixed order (how are you, business, about,
+        help, thanks, goodbye; dict order within business and about), so each
+        phrase gets its rank in that order. The pattern is a lookahead, so it
+        reports phrases that overlap ("business features" and "features"),
+        and at each position the best-ranked phrase that starts there wins.
+        """
+        intents = [(phrase, self.how_are_you_responses) for phrase in HOW_ARE_YOU_PHRASES]
+        intents += list(self.business_responses.items())
+        intents += list(self.about_responses.items())
+        intents += [(phrase, self.help_responses) for phrase in HELP_PHRASES]
+        intents += [(phrase, THANKS_REPLY) for phrase in THANKS_PHRASES]
+        intents += [(phrase, GOODBYE_REPLY) for phrase in GOODBYE_PHRASES]
+
+        self._intent_rank = {}  # phrase -> (rank, reply or list of replies)
+        for rank, (phrase, reply) in enumerate(intents):
+            self._intent_rank.setdefault(phrase, (rank, reply))
+        ordered = sorted(self._intent_rank, key=lambda phrase: self._intent_rank[phrase][0])
+        self._intent_pattern = re.compile('(?=(' + '|'.join(map(re.escape, ordered)) + '))')
+
+    def match_intent(self, message_lower):
+        """The reply (or list of replies) for the first intent in the message, else None"""
+        best = None
+        for match in self._intent_pattern.finditer(message_lower):
+            found = self._intent_rank[match.group(1)]
+            if best is None or found[0] < best[0]:
+                best = found
+                if best[0] == 0:
+                    break
+        return best[1] if best else None
     
     def get_response(self, user_message: str, context: dict = None) -> str:
         """
@@ -73,38 +129,29 @@ class FallbackResponder:
         message_lower = user_message.lower().strip()
         
         # Check for greetings
-        if message_lower in ['hi', 'hello', 'hey', 'yo', 'sup', 'what\'s up', 'hey there']:
+        if message_lower in GREETINGS:
             return random.choice(self.greeting_responses)
         
-        # Check for "how are you"
-        if any(phrase in message_lower for phrase in ['how are you', 'how you doing', 'how\'s it going', 'how you been']):
-            return random.choice(self.how_are_you_responses)
-        
-        # Check business/feature questions
-        for key, response in self.business_responses.items():
-            if key in message_lower:
-                return response
-        
-        # Check about/who are you questions
-        for key, response in self.about_responses.items():
-            if key in message_lower:
-                return response
-        
-        # Check for help requests
-        if any(word in message_lower for word in ['help', 'assist', 'support', 'what can you']):
-            return random.choice(self.help_responses)
-        
-        # Check for gratitude
-        if any(word in message_lower for word in ['thank', 'thanks', 'appreciate', 'grateful']):
-            return "You're very welcome! Happy to help! 😊"
-        
-        # Check for goodbye/exit
-        if any(word in message_lower for word in ['bye', 'goodbye', 'see you', 'take care', 'exit', 'quit']):
-            return "Goodbye! It was great chatting with you. Have an awesome day! 👋"
+        # How are you, business/feature and about questions, help requests,
+        # gratitude and goodbyes, in that order of precedence
+        reply = self.match_intent(message_lower)
+        if reply is not None:
+            return random.choice(reply) if isinstance(reply, list) else reply
         
         # Generic fallback for unknown queries
         return self.generate_contextual_response(user_message, context)
     
+    def intent_reply(self, intent: str):
+        """A reply for an intent named by the local classifier, or None"""
+        replies = {
+            'greeting': self.greeting_responses,
+            'how_are_you': self.how_are_you_responses,
+            'help': self.help_responses,
+            'thanks': [THANKS_REPLY],
+            'goodbye': [GOODBYE_REPLY],
+        }.get(intent)
+        return random.choice(replies) if replies else None
+    
     def generate_contextual_response(self, user_message: str, context: dict = None) -> str:
         """Generate a contextual response that acknowledges user input"""
         keywords = self.extract_keywords(user_message)
@@ -123,13 +170,20 @@ class FallbackResponder:
     def extract_keywords(self, text: str, limit: int = 3) -> list:
         """Extract important keywords from text"""
         # Simple keyword extraction
-        stop_words = {'a', 'an', 'the', 'and', 'or', 'but', 'in', 'on', 'at', 'to', 'for', 'of', 'is', 'are', 'be', 'was', 'were', 'i', 'you', 'we', 'he', 'she', 'it', 'what', 'how', 'why', 'when', 'where', 'can', 'could', 'would', 'should', 'do', 'does', 'did', 'will', 'have', 'has', 'had'}
-        
         words = text.lower().split()
-        keywords = [w for w in words if len(w) > 3 and w not in stop_words and w.isalpha()]
+        keywords = [w for w in words if len(w) > 3 and w not in STOP_WORDS and w.isalpha()]
         return keywords[:limit]
 
 
+# Built once; get_response only reads it, so all threads share it
+_responder = FallbackResponder()
+
+
+def get_intent_reply(intent: str):
+    """Reply for a small-talk intent (greeting, how_are_you, help, thanks, goodbye)"""
+    return _responder.intent_reply(intent)
+
+
 def get_fallback_response(user_message: str, selected_voice: str = "Anna", context: dict = None) -> dict:
     """
     Get a fallback response with all required fields for the chat endpoint.
@@ -142,31 +196,23 @@ def get_fallback_response(user_message: str, selected_voice: str = "Anna", conte
     Returns:
         Dict with reply, voice info, and session data
     """
-    responder = FallbackResponder()
-    reply = responder.get_response(user_message, context)
-    
-    backend_voice_map = {
-        'Anna': 'Microsoft Zira',
-        'Irish': 'Microsoft Siobhan',
-        'Alexa': 'Amazon Alexa',
-        'Jak': 'Microsoft Jak',
-        'Alecx': 'Microsoft Alecx'
-    }
+    reply = _responder.get_response(user_message, context)
+    now = datetime.now().timestamp()
     
     return {
         "reply": reply,
         "voice_response_finished": True,
         "selected_voice": selected_voice,
-        "backend_voice": backend_voice_map.get(selected_voice, 'Microsoft Zira'),
+        "backend_voice": BACKEND_VOICE_MAP.get(selected_voice, 'Microsoft Zira'),
         "message_saved": True,
-        "timestamp": datetime.now().timestamp(),
+        "timestamp": now,
         "success": True,
         "source": "fallback",
         "is_mobile": False,
         "voice_session": {
             "active": True,
             "should_listen": True,
-            "listening_until": datetime.now().timestamp() + 120,
+            "listening_until": now + 120,
             "time_remaining": 120
         }
     }
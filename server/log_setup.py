@@ -0,0 +1,186 @@
+"""
+Buffered structured logging.
+Request threads only put log records on a queue; a background thread writes
+them to stdout and, as JSON lines, to a size-rotated api_debug.log. Levels can
+be set per module, e.g. LOG_LEVELS="key_pool=WARNING,memory_store=INFO".
+
+RotatingFileHandler is not safe across processes (two workers rotating the
+same file lose or clobber lines), so with several workers each process
+writes and rotates its own api_debug.<pid>.log.
+"""
+
+import atexit
+import contextvars
+import json
+import logging
+import logging.handlers
+import os
+import queue
+import sys
+import threading
+import time
+
+LOG_LEVEL = os.getenv('LOG_LEVEL', 'INFO').upper()
+LOG_LEVELS = os.getenv('LOG_LEVELS', '')
+LOG_FILE = os.getenv('LOG_FILE', 'api_debug.log')  # empty disables the file
+LOG_MAX_BYTES = int(os.getenv('LOG_MAX_BYTES', str(5 * 1024 * 1024)))
+LOG_BACKUP_COUNT = int(os.getenv('LOG_BACKUP_COUNT', '3'))
+LOG_QUEUE_SIZE = int(os.getenv('LOG_QUEUE_SIZE', '10000'))
+
+
+def gunicorn_workers(argv=None):
+    """Worker count from a gunicorn command line (-w N, --workers N or --workers=N), or None"""
+    argv = sys.argv if argv is None else argv
+    if not argv or 'gunicorn' not in argv[0]:
+        return None
+    for i, arg in enumerate(argv):
+        if arg in ('-w', '--workers') and i + 1 < len(argv):
+            value = argv[i + 1]
+        elif arg.startswith('--workers='):
+            value = arg.split('=', 1)[1]
+        elif arg.startswith('-w') and arg[2:].isdigit():
+            value = arg[2:]
+        else:
+            continue
+        try:
+            return int(value)
+        except ValueError:
+            return None
+    return None
+
+
+# Worker processes serving the app. gunicorn's own --workers wins over
+# WEB_CONCURRENCY (which gunicorn also reads when --workers isn't given)
+WEB_CONCURRENCY = gunicorn_workers() or int(os.getenv('WEB_CONCURRENCY', '1'))
+
+ROOT_LOGGER = 'bzik'
+
+# Set while a chat request is being handled, so its log lines carry its ID
+request_id_var = contextvars.ContextVar('request_id', default=None)
+
+_configure_lock = threading.Lock()
+_listener = None
+_queue_handler = None
+
+
+class JsonLineFormatter(logging.Formatter):
+    """One JSON object per record"""
+
+    def format(self, record):
+        entry = {
+            "time": time.strftime('%Y-%m-%dT%H:%M:%S', time.localtime(record.created)) + f".{int(record.msecs):03d}",
+            "level": record.levelname,
+            "logger": record.name[len(ROOT_LOGGER) + 1:] or record.name,
+            "thread": record.threadName,
+            "message": record.getMessage(),
+        }
+        request_id = getattr(record, 'request_id', None)
+        if request_id:
+            entry["request_id"] = request_id
+        trace = getattr(record, 'trace', None)
+        if trace is not None:
+            entry["trace"] = trace
+        if record.exc_text:
+            entry["exc"] = record.exc_text
+        return json.dumps(entry, ensure_ascii=False)
+
+
+class DroppingQueueHandler(logging.handlers.QueueHandler):
+    """Never blocks the caller: when the queue is full the record is dropped and counted"""
+
+    def __init__(self, log_queue):
+        super().__init__(log_queue)
+        self.dropped = 0
+        self._exc_formatter = logging.Formatter()
+
+    def prepare(self, record):
+        # Render the message and traceback on the calling thread (the objects
+        # they refer to may change later), but keep the record's fields so the
+        # writer thread can still format it either way
+        message = record.getMessage()
+        exc_text = record.exc_text
+        if record.exc_info and not exc_text:
+            exc_text = self._exc_formatter.formatException(record.exc_info)
+        record = logging.makeLogRecord(record.__dict__)
+        record.msg, record.args = message, None
+        record.exc_info, record.exc_text = None, exc_text
+        record.request_id = request_id_var.get()
+        return record
+
+    def enqueue(self, record):
+        try:
+            self.queue.put_nowait(record)
+        except queue.Full:
+            self.dropped += 1
+
+
+def _parse_levels(spec):
+    """"memory_store=INFO,key_pool=WARNING" -> {"memory_store": "INFO", ...}"""
+    levels = {}
+    for part in spec.split(','):
+        name, _, level = part.partition('=')
+        if name.strip() and level.strip():
+            levels[name.strip()] = level.strip().upper()
+    return levels
+
+
+def log_file_path(path=LOG_FILE, workers=WEB_CONCURRENCY):
+    """The file this process writes: api_debug.log, or api_debug.<pid>.log with several workers"""
+    if workers <= 1:
+        return path
+    root, ext = os.path.splitext(path)
+    return f"{root}.{os.getpid()}{ext}"
+
+
+def configure_logging():
+    """Set up the queue handler and writer thread once per process"""
+    global _listener, _queue_handler
+    with _configure_lock:
+        if _listener is not None:
+            return
+        root = logging.getLogger(ROOT_LOGGER)
+        root.setLevel(LOG_LEVEL)
+        root.propagate = False  # keep our lines out of werkzeug/uvicorn handlers
+        for name, level in _parse_levels(LOG_LEVELS).items():
+            logging.getLogger(f"{ROOT_LOGGER}.{name}").setLevel(level)
+
+        console = logging.StreamHandler(sys.stdout)
+        console.setFormatter(logging.Formatter('%(message)s'))
+        handlers = [console]
+        if LOG_FILE:
+            path = log_file_path()
+            try:
+                file_handler = logging.handlers.RotatingFileHandler(
+                    path, maxBytes=LOG_MAX_BYTES, backupCount=LOG_BACKUP_COUNT, encoding='utf-8')
+                file_handler.setFormatter(JsonLineFormatter())
+                handlers.append(file_handler)
+            except OSError as e:
+                print(f"[Logging] Could not open {path}: {e}")
+
+        log_queue = queue.Queue(LOG_QUEUE_SIZE)
+        _queue_handler = DroppingQueueHandler(log_queue)
+        root.addHandler(_queue_handler)
+        _listener = logging.handlers.QueueListener(log_queue, *handlers, respect_handler_level=True)
+        _listener.start()
+        atexit.register(shutdown_logging)
+
+
+def shutdown_logging():
+    """Write out whatever is still queued and stop the writer thread"""
+    global _listener
+    with _configure_lock:
+        if _listener is None:
+            return
+        _listener.stop()
+        _listener = None
+        logging.getLogger(ROOT_LOGGER).removeHandler(_queue_handler)
+
+
+def dropped_count():
+    return _queue_handler.dropped if _queue_handler else 0
+
+
+def get_logger(name):
+    """Logger for one module; configures logging on first use"""
+    configure_logging()
+    return logging.getLogger(f"{ROOT_LOGGER}.{name}")
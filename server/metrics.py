@@ -0,0 +1,195 @@
+"""
+Prometheus-style metrics.
+Counters and histograms are cheap enough to update on every request: each
+thread increments its own shard without taking a lock, and shards are only
+summed when /api/metrics is scraped. Gauges are read from callbacks at scrape
+time.
+"""
+
+import bisect
+import threading
+import weakref
+
+DEFAULT_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0)
+MAX_LIVE_SHARDS = 256  # fold shards of finished threads into the total past this many
+
+
+class _ShardedValues:
+    """label tuple -> value, sharded per thread.
+
+    A thread only ever writes its own dict, so updates need no lock. The
+    registry lock is taken when a thread first touches the metric and when
+    shards are summed.
+    """
+
+    def __init__(self, new_value, merge):
+        self._new_value = new_value
+        self._merge = merge  # merge(into, value)
+        self._local = threading.local()
+        self._lock = threading.Lock()
+        self._shards = []  # (weakref to thread, dict)
+        self._retired = {}  # values from threads that have exited
+
+    def shard(self):
+        values = getattr(self._local, 'values', None)
+        if values is None:
+            values = self._local.values = {}
+            with self._lock:
+                if len(self._shards) >= MAX_LIVE_SHARDS:
+                    self._retire_dead()
+                self._shards.append((weakref.ref(threading.current_thread()), values))
+        return values
+
+    def _retire_dead(self):
+        """Fold shards of threads that have exited into _retired (caller holds the lock)"""
+        live = []
+        for thread_ref, values in self._shards:
+            thread = thread_ref()
+            if thread is None or not thread.is_alive():
+                self._fold(self._retired, values)
+            else:
+                live.append((thread_ref, values))
+        self._shards = live
+
+    def _fold(self, into, values):
+        for labels, value in list(values.items()):
+            if labels not in into:
+                into[labels] = self._new_value()
+            into[labels] = self._merge(into[labels], value)
+
+    def collect(self):
+        with self._lock:
+            self._retire_dead()
+            totals = {}
+            self._fold(totals, self._retired)
+            for _, values in self._shards:
+                self._fold(totals, values)
+        return totals
+
+
+def _format_labels(names, values, extra=()):
+    pairs = list(zip(names, values)) + list(extra)
+    if not pairs:
+        return ''
+    escaped = (str(v).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n') for _, v in pairs)
+    return '{' + ','.join(f'{name}="{value}"' for (name, _), value in zip(pairs, escaped)) + '}'
+
+
+def _format_number(value):
+    if value == float('inf'):
+        return '+Inf'
+    if isinstance(value, float) and value.is_integer():
+        return str(int(value))
+    return repr(value) if isinstance(value, float) else str(value)
+
+
+class Counter:
+    def __init__(self, name, help_text, labels=()):
+        self.name = name
+        self.help_text = help_text
+        self.label_names = tuple(labels)
+        self._values = _ShardedValues(int, lambda total, value: total + value)
+
+    def inc(self, *label_values, amount=1):
+        values = self._values.shard()
+        values[label_values] = values.get(label_values, 0) + amount
+
+    def value(self, *label_values):
+        return self._values.collect().get(label_values, 0)
+
+    def render(self):
+        lines = [f"# HELP {self.name} {self.help_text}", f"# TYPE {self.name} counter"]
+        for label_values, value in sorted(self._values.collect().items()):
+            lines.append(f"{self.name}{_format_labels(self.label_names, label_values)} {_format_number(value)}")
+        return lines
+
+
+class Histogram:
+    def __init__(self, name, help_text, labels=(), buckets=DEFAULT_BUCKETS):
+        self.name = name
+        self.help_text = help_text
+        self.label_names = tuple(labels)
+        self.buckets = tuple(sorted(buckets))
+        size = len(self.buckets) + 1  # last slot is +Inf
+
+        def new_value():
+            return [[0] * size, 0.0]  # per-bucket counts (not cumulative), sum
+
+        def merge(total, value):
+            counts, total_sum = total
+            for i, count in enumerate(value[0]):
+                counts[i] += count
+            return [counts, total_sum + value[1]]
+
+        self._new_value = new_value
+        self._values = _ShardedValues(new_value, merge)
+
+    def observe(self, amount, *label_values):
+        values = self._values.shard()
+        entry = values.get(label_values)
+        if entry is None:
+            entry = values[label_values] = self._new_value()
+        entry[0][bisect.bisect_left(self.buckets, amount)] += 1
+        entry[1] += amount
+
+    def render(self):
+        lines = [f"# HELP {self.name} {self.help_text}", f"# TYPE {self.name} histogram"]
+        for label_values, (counts, total_sum) in sorted(self._values.collect().items()):
+            cumulative = 0
+            for bound, count in zip(self.buckets + (float('inf'),), counts):
+                cumulative += count
+                labels = _format_labels(self.label_names, label_values, [('le', _format_number(float(bound)))])
+                lines.append(f"{self.name}_bucket{labels} {cumulative}")
+            labels = _format_labels(self.label_names, label_values)
+            lines.append(f"{self.name}_sum{labels} {_format_number(total_sum)}")
+            lines.append(f"{self.name}_count{labels} {cumulative}")
+        return lines
+
+
+class Gauge:
+    """Value(s) read at scrape time; `callback` returns a number or {label tuple: number}"""
+
+    def __init__(self, name, help_text, callback, labels=(), metric_type='gauge'):
+        self.name = name
+        self.help_text = help_text
+        self.label_names = tuple(labels)
+        self.callback = callback
+        self.metric_type = metric_type
+
+    def render(self):
+        lines = [f"# HELP {self.name} {self.help_text}", f"# TYPE {self.name} {self.metric_type}"]
+        values = self.callback()
+        if not isinstance(values, dict):
+            values = {(): values}
+        for label_values, value in sorted(values.items()):
+            lines.append(f"{self.name}{_format_labels(self.label_names, label_values)} {_format_number(value)}")
+        return lines
+
+
+class Registry:
+    CONTENT_TYPE = 'text/plain; version=0.0.4; charset=utf-8'
+
+    def __init__(self):
+        self._metrics = []
+
+    def register(self, metric):
+        self._metrics.append(metric)
+        return metric
+
+    def counter(self, name, help_text, labels=()):
+        return self.register(Counter(name, help_text, labels))
+
+    def histogram(self, name, help_text, labels=(), buckets=DEFAULT_BUCKETS):
+        return self.register(Histogram(name, help_text, labels, buckets))
+
+    def gauge(self, name, help_text, callback, labels=(), metric_type='gauge'):
+        return self.register(Gauge(name, help_text, callback, labels, metric_type))
+
+    def render(self):
+        lines = []
+        for metric in self._metrics:
+            try:
+                lines.extend(metric.render())
+            except Exception as e:
+                lines.append(f"# {metric.name} unavailable: {e}")
+        return '\n'.join(lines) + '\n'
@@ -0,0 +1,153 @@
+"""
+Cross-user response cache.
+Many users ask the same small questions ("what can you do", "who made you").
+Replies from the API are cached by normalized message, voice and a short
+fingerprint of the recent conversation, so a repeat can be answered without
+another upstream call. Optionally, near-identical messages also match, using
+character trigram similarity.
+"""
+
+import hashlib
+import math
+import threading
+import time
+from collections import Counter, OrderedDict
+
+
+def _default_normalize(text):
+    if not text:
+        return ''
+    raw = ''.join(c for c in text.lower() if c.isalnum() or c.isspace())
+    return ' '.join(raw.split())
+
+
+def trigram_vector(text):
+    """Character trigram counts of the padded text"""
+    padded = f"  {text} "
+    return Counter(padded[i:i + 3] for i in range(len(padded) - 2))
+
+
+def cosine_similarity(a, b):
+    if not a or not b:
+        return 0.0
+    if len(a) > len(b):
+        a, b = b, a
+    dot = sum(count * b.get(gram, 0) for gram, count in a.items())
+    if not dot:
+        return 0.0
+    norm_a = math.sqrt(sum(c * c for c in a.values()))
+    norm_b = math.sqrt(sum(c * c for c in b.values()))
+    return dot / (norm_a * norm_b)
+
+
+class _CacheEntry:
+    __slots__ = ('reply', 'expires_at', 'bucket', 'vector')
+
+    def __init__(self, reply, expires_at, bucket, vector):
+        self.reply = reply
+        self.expires_at = expires_at
+        self.bucket = bucket
+        self.vector = vector
+
+
+class ResponseCache:
+    """LRU + TTL cache of API replies shared by all users.
+
+    Entries are grouped into buckets by (voice, context fingerprint). An exact
+    lookup is a single dict access; with `similarity_threshold` set, a miss
+    falls back to comparing trigram vectors against the (small) bucket.
+    """
+
+    def __init__(self, max_entries=2000, ttl=600, similarity_threshold=0.0,
+                 context_turns=2, normalize=None, max_bucket_scan=200):
+        self.max_entries = max_entries
+        self.ttl = ttl
+        self.similarity_threshold = similarity_threshold
+        self.context_turns = context_turns
+        self.normalize = normalize or _default_normalize
+        self.max_bucket_scan = max_bucket_scan
+        self._entries = OrderedDict()  # (bucket, normalized message) -> _CacheEntry, oldest first
+        self._buckets = {}  # bucket -> OrderedDict of normalized message -> None
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+    def context_fingerprint(self, conversation):
+        """Short hash of the last `context_turns` entries, so context-dependent replies don't leak"""
+        if not self.context_turns or not conversation:
+            return ''
+        recent = conversation[-self.context_turns:]
+        joined = '\x1f'.join(f"{m.get('role')}:{self.normalize(m.get('content') or '')}" for m in recent)
+        return hashlib.sha1(joined.encode('utf-8')).hexdigest()[:16]
+
+    def _bucket(self, voice, conversation):
+        return (voice, self.context_fingerprint(conversation))
+
+    def get(self, message, voice, conversation):
+        """Return a cached reply for this message and context, or None"""
+        normalized = self.normalize(message)
+        if not normalized:
+            return None
+        bucket = self._bucket(voice, conversation)
+        now = time.time()
+        with self._lock:
+            key = (bucket, normalized)
+            entry = self._entries.get(key)
+            if entry is not None and entry.expires_at <= now:
+                self._remove(key)
+                entry = None
+            if entry is None and self.similarity_threshold > 0:
+                key, entry = self._find_similar(bucket, normalized, now)
+            if entry is None:
+                self.misses += 1
+                return None
+            self._entries.move_to_end(key)
+            self.hits += 1
+            return entry.reply
+
+    def _find_similar(self, bucket, normalized, now):
+        members = self._buckets.get(bucket)
+        if not members:
+            return None, None
+        vector = trigram_vector(normalized)
+        best_key, best_entry, best_score = None, None, self.similarity_threshold
+        # Newest entries first; only scan a bounded number of them
+        for scanned, member in enumerate(reversed(members)):
+            if scanned >= self.max_bucket_scan:
+                break
+            entry = self._entries[(bucket, member)]
+            if entry.expires_at <= now:
+                continue
+            score = cosine_similarity(vector, entry.vector)
+            if score >= best_score:
+                best_key, best_entry, best_score = (bucket, member), entry, score
+        return best_key, best_entry
+
+    def put(self, message, voice, conversation, reply):
+        normalized = self.normalize(message)
+        if not normalized or not reply or self.max_entries <= 0:
+            return
+        bucket = self._bucket(voice, conversation)
+        key = (bucket, normalized)
+        vector = trigram_vector(normalized) if self.similarity_threshold > 0 else None
+        with self._lock:
+            if key in self._entries:
+                self._remove(key)
+            self._entries[key] = _CacheEntry(reply, time.time() + self.ttl, bucket, vector)
+            self._buckets.setdefault(bucket, OrderedDict())[normalized] = None
+            while len(self._entries) > self.max_entries:
+                self._remove(next(iter(self._entries)))
+
+    def _remove(self, key):
+        """Drop one entry (caller holds the lock)"""
+        entry = self._entries.pop(key, None)
+        if entry is None:
+            return
+        members = self._buckets.get(entry.bucket)
+        if members is not None:
+            members.pop(key[1], None)
+            if not members:
+                del self._buckets[entry.bucket]
+
+    def __len__(self):
+        return len(self._entries)
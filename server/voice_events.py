@@ -0,0 +1,81 @@
+"""
+Push channel for voice session events.
+Instead of each open tab polling /api/voice/status every two seconds, the
+frontend keeps one Server-Sent Events stream open and the server sends
+"listening_window", "silence_prompt" and "session_ended" events when they
+happen. Timers (the silence timeout, the grace period after the prompt) run
+on one scheduler thread.
+"""
+
+import heapq
+import itertools
+import threading
+import time
+
+from log_setup import get_logger
+
+logger = get_logger('voice_events')
+
+
+class VoiceEventHub:
+    """Per-user subscribers plus a single timer thread.
+
+    A subscriber is a callable `deliver(event, payload)`; it must not block
+    (the Flask endpoint puts onto a queue, the ASGI one hands off to its event
+    loop). Timer callbacks run on the scheduler thread.
+    """
+
+    def __init__(self):
+        self._subscribers = {}  # user_id -> list of deliver callables
+        self._lock = threading.Lock()
+        self._timers = []  # heap of (when, seq, callback, args)
+        self._seq = itertools.count()
+        self._wakeup = threading.Condition()
+        self._thread = None
+
+    def subscribe(self, user_id, deliver):
+        with self._lock:
+            self._subscribers.setdefault(user_id, []).append(deliver)
+
+    def unsubscribe(self, user_id, deliver):
+        with self._lock:
+            subscribers = self._subscribers.get(user_id)
+            if subscribers and deliver in subscribers:
+                subscribers.remove(deliver)
+                if not subscribers:
+                    del self._subscribers[user_id]
+
+    def has_subscribers(self, user_id):
+        return user_id in self._subscribers
+
+    def publish(self, user_id, event, payload):
+        with self._lock:
+            subscribers = list(self._subscribers.get(user_id, ()))
+        for deliver in subscribers:
+            try:
+                deliver(event, payload)
+            except Exception as e:
+                logger.warning(f"[Voice Events] Could not deliver {event} to {user_id}: {e}")
+
+    def call_at(self, when, callback, *args):
+        """Run callback(*args) on the scheduler thread at time.time() >= when"""
+        with self._wakeup:
+            heapq.heappush(self._timers, (when, next(self._seq), callback, args))
+            if self._thread is None:
+                self._thread = threading.Thread(target=self._run_timers, name='voice-events', daemon=True)
+                self._thread.start()
+            self._wakeup.notify()
+
+    def _run_timers(self):
+        while True:
+            with self._wakeup:
+                while True:
+                    now = time.time()
+                    if self._timers and self._timers[0][0] <= now:
+                        _, _, callback, args = heapq.heappop(self._timers)
+                        break
+                    self._wakeup.wait(self._timers[0][0] - now if self._timers else None)
+            try:
+                callback(*args)
+            except Exception as e:
+                logger.exception(f"[Voice Events] Timer callback failed: {e}")
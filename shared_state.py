@@ -0,0 +1,186 @@
+"""
+State shared between gunicorn workers (and, with Redis, between servers).
+Each worker used to keep its own duplicate-message cache, voice sessions and
+key cooldowns, so a retried message that landed on the other worker wasn't
+recognised and a rate-limited key kept getting used by the worker that
+hadn't seen the 429. The stores here hold small JSON values with a TTL,
+grouped by namespace:
+
+- LocalSharedState: in-process only (a single worker)
+- SQLiteSharedState: one SQLite file, shared by every worker on the machine
+- RedisSharedState: any Redis-compatible server (needs the `redis` package)
+"""
+
+import json
+import sqlite3
+import threading
+import time
+
+from log_setup import get_logger
+
+logger = get_logger('shared_state')
+
+PURGE_EVERY_WRITES = 500  # delete expired SQLite rows after this many writes
+
+
+class LocalSharedState:
+    """Same interface as the shared backends, for a single process"""
+
+    shared = False
+
+    def __init__(self):
+        self._data = {}  # (namespace, key) -> (value, expires_at)
+        self._lock = threading.Lock()
+
+    def get(self, namespace, key):
+        entry = self._data.get((namespace, key))
+        if entry is None or entry[1] <= time.time():
+            return None
+        return entry[0]
+
+    def set(self, namespace, key, value, ttl):
+        with self._lock:
+            self._data[(namespace, key)] = (value, time.time() + ttl)
+            if len(self._data) % PURGE_EVERY_WRITES == 0:
+                now = time.time()
+                for item_key in [k for k, (_, expires_at) in self._data.items() if expires_at <= now]:
+                    del self._data[item_key]
+
+    def delete(self, namespace, key):
+        with self._lock:
+            self._data.pop((namespace, key), None)
+
+    def items(self, namespace):
+        now = time.time()
+        return {key: value for (ns, key), (value, expires_at) in list(self._data.items())
+                if ns == namespace and expires_at > now}
+
+    def count(self, namespace):
+        return len(self.items(namespace))
+
+
+class SQLiteSharedState:
+    """Rows of (namespace, key, JSON value, expiry) in a WAL-mode SQLite file"""
+
+    shared = True
+
+    def __init__(self, db_path):
+        self.db_path = db_path
+        self._local = threading.local()
+        self._writes = 0
+        conn = self._connect()
+        conn.execute("PRAGMA journal_mode=WAL")
+        conn.execute(
+            "CREATE TABLE IF NOT EXISTS shared_state ("
+            " namespace TEXT NOT NULL,"
+            " key TEXT NOT NULL,"
+            " value TEXT NOT NULL,"
+            " expires_at REAL NOT NULL,"
+            " PRIMARY KEY (namespace, key))"
+        )
+
+    def _connect(self):
+        """Return this thread's connection (sqlite3 connections can't be shared across threads)"""
+        conn = getattr(self._local, 'conn', None)
+        if conn is None:
+            conn = sqlite3.connect(self.db_path, timeout=10, isolation_level=None)
+            conn.execute("PRAGMA synchronous=NORMAL")
+            conn.execute("PRAGMA busy_timeout=10000")
+            self._local.conn = conn
+        return conn
+
+    def get(self, namespace, key):
+        row = self._connect().execute(
+            "SELECT value FROM shared_state WHERE namespace = ? AND key = ? AND expires_at > ?",
+            (namespace, key, time.time())
+        ).fetchone()
+        return json.loads(row[0]) if row else None
+
+    def set(self, namespace, key, value, ttl):
+        conn = self._connect()
+        now = time.time()
+        conn.execute(
+            "INSERT OR REPLACE INTO shared_state (namespace, key, value, expires_at) VALUES (?, ?, ?, ?)",
+            (namespace, key, json.dumps(value), now + ttl)
+        )
+        self._writes += 1
+        if self._writes % PURGE_EVERY_WRITES == 0:
+            conn.execute("DELETE FROM shared_state WHERE expires_at <= ?", (now,))
+
+    def delete(self, namespace, key):
+        self._connect().execute("DELETE FROM shared_state WHERE namespace = ? AND key = ?", (namespace, key))
+
+    def items(self, namespace):
+        rows = self._connect().execute(
+            "SELECT key, value FROM shared_state WHERE namespace = ? AND expires_at > ?",
+            (namespace, time.time())
+        ).fetchall()
+        return {key: json.loads(value) for key, value in rows}
+
+    def count(self, namespace):
+        return self._connect().execute(
+            "SELECT COUNT(*) FROM shared_state WHERE namespace = ? AND expires_at > ?",
+            (namespace, time.time())
+        ).fetchone()[0]
+
+
+class RedisSharedState:
+    """Keys are "<prefix><namespace>:<key>" with a Redis TTL.
+
+    A Redis outage degrades to "nothing shared" (misses, lost writes) rather
+    than failing chat requests.
+    """
+
+    shared = True
+
+    def __init__(self, url, prefix='bzik:'):
+        import redis  # optional dependency, only needed for this backend
+        self._redis = redis.Redis.from_url(url, socket_timeout=2, socket_connect_timeout=2)
+        self._redis.ping()
+        self.prefix = prefix
+
+    def _name(self, namespace, key):
+        return f"{self.prefix}{namespace}:{key}"
+
+    def _call(self, default, operation, *args, **kwargs):
+        try:
+            return operation(*args, **kwargs)
+        except Exception as e:
+            logger.warning(f"[Shared State] Redis error: {e}")
+            return default
+
+    def get(self, namespace, key):
+        raw = self._call(None, self._redis.get, self._name(namespace, key))
+        return json.loads(raw) if raw is not None else None
+
+    def set(self, namespace, key, value, ttl):
+        self._call(None, self._redis.set, self._name(namespace, key), json.dumps(value), px=max(1, int(ttl * 1000)))
+
+    def delete(self, namespace, key):
+        self._call(None, self._redis.delete, self._name(namespace, key))
+
+    def items(self, namespace):
+        start = len(self._name(namespace, ''))
+        names = self._call([], lambda: list(self._redis.scan_iter(match=self._name(namespace, '*'), count=100)))
+        if not names:
+            return {}
+        values = self._call([None] * len(names), self._redis.mget, names)
+        return {name.decode()[start:]: json.loads(raw) for name, raw in zip(names, values) if raw is not None}
+
+    def count(self, namespace):
+        return self._call(0, lambda: sum(1 for _ in self._redis.scan_iter(match=self._name(namespace, '*'), count=100)))
+
+
+def create_shared_state(backend, location=None):
+    """Build the configured backend ('sqlite', 'redis' or 'local')"""
+    if backend == 'local':
+        return LocalSharedState()
+    if backend == 'redis':
+        try:
+            return RedisSharedState(location)
+        except Exception as e:
+            logger.warning(f"[Shared State] Redis unavailable ({e}), using in-process state")
+            return LocalSharedState()
+    if backend != 'sqlite':
+        logger.warning(f"[Shared State] Unknown shared state backend '{backend}', using sqlite")
+    return SQLiteSharedState(location or 'shared_state.db')
@@ -0,0 +1,89 @@
+"""
+In-flight request coalescing.
+The duplicate cache only knows about a message once its reply is saved, so
+when a mobile client fires the same message twice before the first reply
+comes back, both requests went upstream and both exchanges were written to
+memory. Here the first request for a key (user ID plus normalized message)
+does the work and any request for the same key that arrives meanwhile waits
+for its result instead.
+"""
+
+import asyncio
+import threading
+from concurrent.futures import Future
+
+
+class SingleFlight:
+    """key -> Future of the call currently running for it, for threaded servers"""
+
+    def __init__(self):
+        self._calls = {}
+        self._lock = threading.Lock()
+
+    def do(self, key, fn, *args):
+        """Run fn(*args) unless a call for key is already running.
+
+        Returns (result, coalesced); coalesced is True when the result came
+        from another request's call. Its exception is re-raised to every
+        waiter as well.
+        """
+        with self._lock:
+            future = self._calls.get(key)
+            leader = future is None
+            if leader:
+                future = self._calls[key] = Future()
+        if not leader:
+            return future.result(), True
+        try:
+            result = fn(*args)
+        except BaseException as e:
+            future.set_exception(e)
+            raise
+        else:
+            future.set_result(result)
+            return result, False
+        finally:
+            with self._lock:
+                del self._calls[key]
+
+    def __len__(self):
+        return len(self._calls)
+
+
+class AsyncSingleFlight:
+    """The same for one event loop; fn is a coroutine function"""
+
+    def __init__(self):
+        self._calls = {}
+
+    async def do(self, key, fn, *args):
+        while True:
+            future = self._calls.get(key)
+            if future is None:
+                break
+            try:
+                # shield: a waiter that gets cancelled must not cancel the call
+                return await asyncio.shield(future), True
+            except asyncio.CancelledError:
+                if not future.cancelled():
+                    raise
+                # The leading request was cancelled (client went away); try again
+
+        future = self._calls[key] = asyncio.get_running_loop().create_future()
+        try:
+            result = await fn(*args)
+        except asyncio.CancelledError:
+            future.cancel()
+            raise
+        except BaseException as e:
+            future.set_exception(e)
+            future.exception()  # mark retrieved, there may be no waiters
+            raise
+        else:
+            future.set_result(result)
+            return result, False
+        finally:
+            del self._calls[key]
+
+    def __len__(self):
+        return len(self._calls)
@@ -0,0 +1,112 @@
+"""
+Per-request stage timing and tracing.
+Each chat request gets a request ID and records how long its stages took
+(fast path, memory load, model call, memory save, serialization) so slow
+replies can be pinned on the right step. Code deeper in the call stack, like
+get_chat_response, adds spans to the active request through span() without
+having the timer passed in. Slow requests (and an optional random sample)
+are written to the trace log.
+"""
+
+import os
+import random
+import re
+import time
+import uuid
+from contextlib import contextmanager
+from contextvars import ContextVar
+
+from log_setup import get_logger, request_id_var
+
+TRACE_SLOW_MS = float(os.getenv('TRACE_SLOW_MS', '2000'))  # always trace requests slower than this
+TRACE_SAMPLE_RATE = float(os.getenv('TRACE_SAMPLE_RATE', '0'))  # fraction of other requests to trace
+
+_current_timer = ContextVar('stage_timer', default=None)
+_trace_logger = get_logger('trace')
+_REQUEST_ID_PATTERN = re.compile(r'^[A-Za-z0-9._-]{1,64}$')
+
+
+def new_request_id(incoming=None):
+    """Reuse a well-formed X-Request-ID from the client, otherwise make one up"""
+    if incoming and _REQUEST_ID_PATTERN.match(incoming):
+        return incoming
+    return uuid.uuid4().hex[:16]
+
+
+class StageTimer:
+    """Accumulates wall-clock milliseconds per named stage, plus the individual spans"""
+
+    def __init__(self, request_id=None):
+        self.request_id = request_id or new_request_id()
+        self.started = time.perf_counter()
+        self.stages = {}  # stage name -> milliseconds, in the order stages first ran
+        self.spans = []  # (name, start offset ms, duration ms, attributes)
+        self._tokens = None
+
+    @contextmanager
+    def stage(self, name, **attrs):
+        start = time.perf_counter()
+        try:
+            yield attrs
+        finally:
+            end = time.perf_counter()
+            self.add(name, (end - start) * 1000)
+            self.spans.append((name, (start - self.started) * 1000, (end - start) * 1000, attrs))
+
+    def add(self, name, ms):
+        self.stages[name] = self.stages.get(name, 0.0) + ms
+
+    def total_ms(self):
+        return (time.perf_counter() - self.started) * 1000
+
+    def as_dict(self):
+        timings = {name: round(ms, 2) for name, ms in self.stages.items()}
+        timings["total"] = round(self.total_ms(), 2)
+        return timings
+
+    def server_timing(self):
+        """Value for the Server-Timing response header"""
+        return ', '.join(f"{name};dur={ms:.2f}" for name, ms in self.as_dict().items())
+
+    def span_list(self):
+        return [
+            dict(attrs, name=name, start=round(start, 2), dur=round(duration, 2))
+            for name, start, duration, attrs in self.spans
+        ]
+
+    def activate(self):
+        """Make this the timer span() records into, for the current thread or task"""
+        self._tokens = (_current_timer.set(self), request_id_var.set(self.request_id))
+
+    def finish(self, **fields):
+        """Deactivate, and write the trace if the request was slow or sampled"""
+        if self._tokens:
+            _current_timer.reset(self._tokens[0])
+            request_id_var.reset(self._tokens[1])
+            self._tokens = None
+        total = self.total_ms()
+        slow = total >= TRACE_SLOW_MS
+        if slow or (TRACE_SAMPLE_RATE > 0 and random.random() < TRACE_SAMPLE_RATE):
+            trace = dict(fields, request_id=self.request_id, slow=slow, total=round(total, 2),
+                         stages=self.as_dict(), spans=self.span_list())
+            stages = ', '.join(f"{name}={ms}ms" for name, ms in trace["stages"].items())
+            _trace_logger.info(f"[Trace] {'Slow' if slow else 'Sampled'} request {self.request_id}: {stages}",
+                               extra={'trace': trace})
+
+
+def current_timer():
+    return _current_timer.get()
+
+
+@contextmanager
+def span(name, **attrs):
+    """Time a block as part of the active request; a no-op outside one.
+
+    Yields a dict that can be filled in with attributes (e.g. the outcome).
+    """
+    timer = _current_timer.get()
+    if timer is None:
+        yield attrs
+        return
+    with timer.stage(name, **attrs) as span_attrs:
+        yield span_attrs
@@ -0,0 +1,182 @@
+"""
+Voice session table.
+A session starts when the bot answers and lasts for the auto-listen window.
+Sessions used to live in a plain dict that only shrank on an exit phrase or
+/api/voice/end, so abandoned tabs stayed forever. Here each session has a
+fixed expiry kept in a heap, a background thread drops expired sessions, and
+the table has a maximum size (the least recently started session goes first).
+"""
+
+import heapq
+import threading
+import time
+from collections import OrderedDict
+
+from log_setup import get_logger
+
+logger = get_logger('voice_sessions')
+
+
+class VoiceSession:
+    __slots__ = ('user_id', 'listening_until', 'last_input', 'silence_start', 'prompt_sent_at')
+    FIELDS = ('listening_until', 'last_input', 'silence_start', 'prompt_sent_at')
+
+    def __init__(self, user_id):
+        self.user_id = user_id
+        self.listening_until = 0.0
+        self.last_input = 0.0
+        self.silence_start = 0.0
+        self.prompt_sent_at = None
+
+    def to_dict(self):
+        return {field: getattr(self, field) for field in self.FIELDS}
+
+    def update(self, values):
+        for field in self.FIELDS:
+            setattr(self, field, values.get(field))
+
+
+class VoiceSessionStore:
+    """user_id -> VoiceSession, expiring each session `ttl` seconds after it (re)starts.
+
+    `on_expire(user_id)` is called (outside the lock) for sessions that time
+    out or are evicted to make room, not for ones ended explicitly.
+
+    With a `shared` state store (see shared_state.py), sessions are also
+    written there and every lookup refreshes from it, so all workers agree
+    on a session. Callers that change a session's fields call save().
+    """
+
+    NAMESPACE = 'voice'
+
+    def __init__(self, ttl, max_sessions=10000, sweep_interval=5.0, on_expire=None, shared=None):
+        self.ttl = ttl
+        self.max_sessions = max_sessions
+        self.on_expire = on_expire
+        self.shared = shared
+        self._sessions = OrderedDict()  # least recently started first
+        self._expiry = []  # heap of (listening_until, user_id); stale entries are skipped
+        self._lock = threading.Lock()
+        if sweep_interval:
+            self._sweep_interval = sweep_interval
+            threading.Thread(target=self._sweep_loop, name='voice-session-sweeper', daemon=True).start()
+
+    def start(self, user_id, now=None):
+        """Start or restart the listening window, reusing the existing record"""
+        now = time.time() if now is None else now
+        evicted = []
+        with self._lock:
+            session = self._sessions.get(user_id)
+            if session is None:
+                session = self._sessions[user_id] = VoiceSession(user_id)
+                while len(self._sessions) > self.max_sessions:
+                    evicted.append(self._sessions.popitem(last=False)[0])
+            else:
+                self._sessions.move_to_end(user_id)
+            session.listening_until = now + self.ttl
+            session.last_input = now
+            session.silence_start = now
+            session.prompt_sent_at = None
+            heapq.heappush(self._expiry, (session.listening_until, user_id))
+            self._compact()
+        self.save(session)
+        if self.shared is not None:
+            # Otherwise another worker would find the evicted session and bring it back
+            for evicted_id in evicted:
+                self.shared.delete(self.NAMESPACE, evicted_id)
+        self._notify(evicted)
+        return session
+
+    def get(self, user_id, now=None):
+        """The live session for this user, or None"""
+        if self.shared is not None:
+            return self._refresh(user_id, now)
+        session = self._sessions.get(user_id)
+        if session is None:
+            return None
+        if session.listening_until <= (time.time() if now is None else now):
+            self.expire(now)
+            return None
+        return session
+
+    def _refresh(self, user_id, now):
+        """Bring the local record in line with the shared one"""
+        values = self.shared.get(self.NAMESPACE, user_id)
+        now = time.time() if now is None else now
+        if values is None or values.get('listening_until', 0) <= now:
+            with self._lock:
+                self._sessions.pop(user_id, None)
+            return None
+        with self._lock:
+            session = self._sessions.get(user_id)
+            if session is None:
+                session = self._sessions[user_id] = VoiceSession(user_id)
+            if session.listening_until != values['listening_until']:
+                heapq.heappush(self._expiry, (values['listening_until'], user_id))
+            session.update(values)
+        return session
+
+    def save(self, session):
+        """Publish a session's fields to the other workers"""
+        if self.shared is not None:
+            ttl = session.listening_until - time.time()
+            if ttl > 0:
+                self.shared.set(self.NAMESPACE, session.user_id, session.to_dict(), ttl)
+
+    def end(self, user_id):
+        """Remove a session; returns True if there was one"""
+        if self.shared is not None:
+            existed = self.shared.get(self.NAMESPACE, user_id) is not None
+            self.shared.delete(self.NAMESPACE, user_id)
+            with self._lock:
+                existed = (self._sessions.pop(user_id, None) is not None) or existed
+            return existed
+        with self._lock:
+            return self._sessions.pop(user_id, None) is not None
+
+    def expire(self, now=None):
+        """Drop sessions whose window has passed; returns their user IDs"""
+        now = time.time() if now is None else now
+        expired = []
+        with self._lock:
+            while self._expiry and self._expiry[0][0] <= now:
+                listening_until, user_id = heapq.heappop(self._expiry)
+                session = self._sessions.get(user_id)
+                # Skip stale heap entries (ended, or restarted since)
+                if session is None or session.listening_until != listening_until:
+                    continue
+                del self._sessions[user_id]
+                expired.append(user_id)
+        if self.shared is not None and expired:
+            # Another worker may have restarted the session since
+            expired = [user_id for user_id in expired if self._refresh(user_id, now) is None]
+        self._notify(expired)
+        return expired
+
+    def _compact(self):
+        """Rebuild the heap when stale entries dominate it (caller holds the lock)"""
+        if len(self._expiry) > 2 * len(self._sessions) + 64:
+            self._expiry = [(s.listening_until, user_id) for user_id, s in self._sessions.items()]
+            heapq.heapify(self._expiry)
+
+    def _notify(self, user_ids):
+        if self.on_expire:
+            for user_id in user_ids:
+                self.on_expire(user_id)
+
+    def _sweep_loop(self):
+        while True:
+            time.sleep(self._sweep_interval)
+            try:
+                self.expire()
+            except Exception as e:
+                logger.exception(f"[Voice] Error expiring sessions: {e}")
+
+    def __contains__(self, user_id):
+        return self.get(user_id) is not None
+
+    def __len__(self):
+        """Live sessions: across all workers when shared, else in this process"""
+        if self.shared is not None:
+            return self.shared.count(self.NAMESPACE)
+        return len(self._sessions)